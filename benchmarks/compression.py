@@ -0,0 +1,159 @@
+"""Measure the bytes saved and CPU spent compressing the main pages
+
+Run from the project root. The pages come from synthetic FEMA data
+seeded like benchmarks.suite does, or from an existing database:
+
+    python3 -m benchmarks.compression
+    python3 -m benchmarks.compression --database postgresql:///disasters
+
+Each page is fetched uncompressed, then compressed with gzip at
+several levels and, if the brotli module is installed, brotli at several
+qualities. The table shows the compressed size, the share saved and the
+CPU milliseconds per response, next to the page's own response time.
+"""
+
+from model import Event, Incident, connect_to_db, db
+from server import app
+from benchmarks.search_indexes import percentile
+from benchmarks.suite import BASE_INCIDENTS, seed_scale
+
+from sqlalchemy import func
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import compress
+import responsecache
+
+
+# Pages measured; {fema_id} is the incident with the most counties
+PAGES = {
+    "events": "/events",
+    "event_detail": "/events/{fema_id}",
+    "search_results": "/search/results?state=CA&disaster-type=all"
+                      "&declaration-id=all&year=&month=",
+    "api_events": "/api/events?state=TX&page-size=500",
+    "api_event": "/api/events/{fema_id}",
+    "api_geo_state": "/api/geo/state",
+    "export_events_csv": "/api/export/events.csv?state=CA&year=2005",
+}
+
+SETTINGS = [("gzip", 1), ("gzip", compress.GZIP_LEVEL), ("gzip", 9),
+            ("br", 1), ("br", compress.BROTLI_QUALITY), ("br", 9)]
+
+
+def cpu_ms(function, repeat):
+    """Return the median CPU milliseconds of function over repeat runs"""
+
+    timings = []
+    for _ in range(repeat):
+        started = time.process_time()
+        function()
+        timings.append((time.process_time() - started) * 1000)
+
+    return percentile(timings, 0.5)
+
+
+def fetch_pages(fema_id, repeat):
+    """Return {name: (body, median response ms)} of every page, uncompressed"""
+
+    client = app.test_client()
+    pages = {}
+
+    for name, template in PAGES.items():
+        path = template.format(fema_id=fema_id)
+        timings = []
+
+        for _ in range(repeat):
+            responsecache.clear()
+            started = time.perf_counter()
+            response = client.get(path, headers={"Accept-Encoding":
+                                                 "identity"})
+            body = response.get_data()
+            timings.append((time.perf_counter() - started) * 1000)
+
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} answered {response.status_code}")
+        pages[name] = (body, percentile(timings, 0.5))
+
+    return pages
+
+
+def measure(pages, repeat):
+    """Print the size, saving and CPU cost of each setting on each page"""
+
+    settings = [(encoding, level) for encoding, level in SETTINGS
+                if encoding == "gzip" or compress.brotli is not None]
+    if len(settings) < len(SETTINGS):
+        print("brotli isn't installed, so only gzip is measured")
+
+    print(f"{'page':<20}{'bytes':>10}{'page ms':>9}  "
+          + "".join(f"{f'{encoding}-{level}':>20}"
+                    for encoding, level in settings))
+    print(f"{'':<39}"
+          + "".join(f"{'saved':>11}{'cpu ms':>9}" for _ in settings))
+
+    totals = {setting: [0, 0.0] for setting in settings}
+    original_total = 0
+
+    for name, (body, page_ms) in pages.items():
+        original_total += len(body)
+        line = f"{name:<20}{len(body):>10}{page_ms:>9.2f}  "
+
+        for encoding, level in settings:
+            def compressed():
+                compressor = compress.Compressor(encoding, level)
+                return compressor.compress(body) + compressor.finish()
+
+            size = len(compressed())
+            cost = cpu_ms(compressed, repeat)
+
+            totals[encoding, level][0] += size
+            totals[encoding, level][1] += cost
+            line += f"{(1 - size / len(body)) * 100:>10.1f}%{cost:>9.3f}"
+
+        print(line)
+
+    line = f"{'all pages':<20}{original_total:>10}{'':>9}  "
+    for size, cost in totals.values():
+        line += f"{(1 - size / original_total) * 100:>10.1f}%{cost:>9.3f}"
+    print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database",
+                        help="database to read (default: seed synthetic "
+                             "data into a temporary SQLite file)")
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    # Searches with no results flash a message, which needs a session
+    app.secret_key = app.secret_key or "benchmark"
+
+    scratch = None
+    if args.database is None:
+        scratch = tempfile.mkdtemp(prefix="disasters-compress-")
+        connect_to_db(app, f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+    else:
+        connect_to_db(app, args.database)
+
+    try:
+        with app.app_context():
+            if scratch:
+                seed_scale(scratch, int(BASE_INCIDENTS * args.scale))
+            fema_id, = (db.session.query(Event.fema_id)
+                        .group_by(Event.fema_id)
+                        .order_by(func.count().desc(), Event.fema_id)
+                        .first())
+            print(f"{Incident.query.count()} incidents, "
+                  f"detail pages for {fema_id}")
+
+        measure(fetch_pages(fema_id, args.repeat), args.repeat)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,125 @@
+"""Time facet counts from the columnar snapshot against SQL GROUP BY
+
+Run from the project root. Synthetic incidents are seeded into a
+throwaway SQLite file like benchmarks.suite does, or an existing
+database is read:
+
+    python3 -m benchmarks.facets --scale 10
+    python3 -m benchmarks.facets --database postgresql:///disasters
+
+The snapshot build time is printed, then the p50 and p99 of counting
+every facet for random filter combinations from the snapshot, and from
+one GROUP BY query per facet. Every snapshot count is checked against
+the SQL one.
+"""
+
+from model import Incident, connect_to_db, db
+from server import app
+from benchmarks.search_indexes import percentile
+from benchmarks.suite import BASE_INCIDENTS, seed_scale
+
+from sqlalchemy import extract, func
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import facets
+
+
+def facet_columns():
+    """Return the SQL expression grouped by for each facet"""
+
+    return {"state_id": Incident.state_id,
+            "disaster_type": Incident.disaster_type,
+            "declaration_id": Incident.declaration_id,
+            "year": extract("year", Incident.declared_on),
+            "month": extract("month", Incident.declared_on)}
+
+
+def sql_counts(filters):
+    """Count every facet with GROUP BY queries, as the snapshot does"""
+
+    columns = facet_columns()
+    counts = {}
+
+    for facet, column in columns.items():
+        query = db.session.query(column, func.count())
+        for other, value in filters.items():
+            if other != facet and value not in facets.UNFILTERED:
+                query = query.filter(columns[other] == value)
+
+        counts[facet] = {str(int(value)) if facet in ("year", "month")
+                         else value: count
+                         for value, count in query.group_by(column)
+                         if value is not None}
+
+    return counts
+
+
+def random_filters(snapshot, generator):
+    """Pick a value, or no filter, for each facet"""
+
+    return {facet: generator.choice(snapshot.values[facet])
+            for facet in facets.FACETS
+            if snapshot.values[facet] and generator.random() < 0.4}
+
+
+def run(repeat, seed_value=0):
+    """Build the snapshot, then time and check random filter combinations"""
+
+    started = time.perf_counter()
+    snapshot = facets.build_snapshot()
+    print(f"{snapshot.size} incidents, snapshot built in "
+          f"{time.perf_counter() - started:.2f}s")
+
+    generator = random.Random(seed_value)
+    snapshot_ms = []
+    sql_ms = []
+
+    for _ in range(repeat):
+        filters = random_filters(snapshot, generator)
+
+        started = time.perf_counter()
+        counts = snapshot.counts(filters)
+        snapshot_ms.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        expected = sql_counts(filters)
+        sql_ms.append((time.perf_counter() - started) * 1000)
+
+        if counts["facets"] != expected:
+            raise AssertionError(f"Counts differ for {filters}")
+
+    for name, timings in (("snapshot", snapshot_ms), ("sql", sql_ms)):
+        print(f"  {name:<10}p50 {percentile(timings, 0.5):8.3f} ms"
+              f"   p99 {percentile(timings, 0.99):8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database",
+                        help="database to read (default: seed synthetic "
+                             "data into a temporary SQLite file)")
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    scratch = None
+    if args.database is None:
+        scratch = tempfile.mkdtemp(prefix="disasters-facets-")
+        connect_to_db(app, f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+    else:
+        connect_to_db(app, args.database)
+
+    try:
+        with app.app_context():
+            if scratch:
+                seed_scale(scratch, int(BASE_INCIDENTS * args.scale))
+            run(args.repeat)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
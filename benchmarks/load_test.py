@@ -0,0 +1,139 @@
+"""Measure how requests per second scale with the number of gunicorn workers
+
+Run from the project root against a seeded database, for example:
+
+    python3 -m benchmarks.load_test --workers 1 2 4 8 --duration 15
+
+For each worker count a gunicorn server is started with gunicorn.conf.py,
+every path is hit by concurrent clients for the given duration, and the
+requests per second are printed. Anonymous pages are served from the
+response cache after their first hit, so use --cycle-pages to spread the
+requests over many different listing and search pages.
+"""
+
+from pagination import encode_cursor
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from urllib.request import urlopen
+
+import argparse
+import itertools
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+PATHS = ["/events",
+         "/search/results?state=CA&disaster-type=all&declaration-id=all"
+         "&year=&month="]
+
+# Search combinations cycled through by --cycle-pages
+STATES = ["CA", "TX", "FL", "NY", "LA", "WA", "OK", "MO", "KY", "all"]
+YEARS = [""] + [str(year) for year in range(1990, 2019)]
+
+
+def cycled_paths(path):
+    """Yield variations of path that miss the response cache"""
+
+    if path.startswith("/search/results"):
+        for state, year in itertools.cycle(itertools.product(STATES, YEARS)):
+            yield (f"/search/results?state={state}&disaster-type=all"
+                   f"&declaration-id=all&year={year}&month=")
+    elif path == "/events":
+        # Listing pages starting after different FEMA IDs, as the page
+        # links would request them
+        for fema_id in itertools.cycle(range(1, 5000)):
+            yield f"/events?cursor={encode_cursor('after', fema_id)}"
+    else:
+        yield from itertools.repeat(path)
+
+
+def start_server(workers, threads, port, database):
+    """Start gunicorn and wait until it answers requests"""
+
+    env = dict(os.environ, WEB_WORKERS=str(workers), WEB_THREADS=str(threads),
+               WEB_BIND=f"127.0.0.1:{port}")
+    if database:
+        env["DATABASE_URL"] = database
+
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn",
+                               "-c", "gunicorn.conf.py", "--access-logfile",
+                               "/dev/null", "wsgi:app"],
+                              env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            urlopen(f"http://127.0.0.1:{port}/about", timeout=1).read()
+            return server
+        except (URLError, ConnectionError):
+            time.sleep(0.1)
+
+    stop_server(server)
+    raise RuntimeError("gunicorn did not start, check gunicorn.conf.py")
+
+
+def stop_server(server):
+    """Shut gunicorn down gracefully"""
+
+    server.send_signal(signal.SIGTERM)
+    server.wait(timeout=60)
+
+
+def hammer(base_url, paths, concurrency, duration):
+    """Send requests from concurrent clients and return (done, errors)"""
+
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+
+    def client(_):
+        done = errors = 0
+        while time.perf_counter() < deadline:
+            with lock:
+                path = next(paths)
+            try:
+                urlopen(base_url + path, timeout=30).read()
+                done += 1
+            except (URLError, ConnectionError):
+                errors += 1
+        return done, errors
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(client, range(concurrency)))
+
+    return sum(done for done, _ in results), sum(errors for _, errors in results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--database", help="defaults to $DATABASE_URL")
+    parser.add_argument("--cycle-pages", action="store_true",
+                        help="vary the pages requested to avoid the cache")
+    parser.add_argument("paths", nargs="*", default=PATHS)
+    args = parser.parse_args()
+
+    print(f"{'workers':<10}{'path':<40}{'req/s':>10}{'errors':>8}")
+
+    for workers in args.workers:
+        server = start_server(workers, args.threads, args.port, args.database)
+        try:
+            for path in args.paths:
+                if args.cycle_pages:
+                    paths = cycled_paths(path)
+                else:
+                    paths = itertools.repeat(path)
+                done, errors = hammer(f"http://127.0.0.1:{args.port}", paths,
+                                      args.concurrency, args.duration)
+                print(f"{workers:<10}{path[:38]:<40}"
+                      f"{done / args.duration:>10.1f}{errors:>8}")
+        finally:
+            stop_server(server)
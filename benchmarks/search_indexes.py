@@ -0,0 +1,192 @@
+"""Time the search queries against a large synthetic events table
+
+Run from the project root against a scratch database, for example:
+
+    createdb disasters_bench
+    python3 -m benchmarks.search_indexes --rows 3000000
+    python3 -m benchmarks.search_indexes --skip-seed --no-indexes
+    python3 -m benchmarks.search_indexes --skip-seed --distinct
+
+Each search combination is run repeatedly and its p50 and p99 latency is
+reported, so the index set in model.py can be compared against none, and
+the incidents table against DISTINCT over the events table.
+"""
+
+from model import Event, Incident, connect_to_db, create_indexes, db
+from seed import EVENT_COLUMNS, batches, insert_batch
+from server import app, filter_events
+
+import incidents
+
+from datetime import date, timedelta
+
+import argparse
+import random
+import time
+
+
+STATES = ["AK", "AL", "AR", "AZ", "CA", "CO", "CT", "FL", "GA", "HI", "IA",
+          "ID", "IL", "IN", "KS", "KY", "LA", "MA", "MD", "ME", "MI", "MN",
+          "MO", "MS", "MT", "NC", "ND", "NE", "NH", "NJ", "NM", "NV", "NY",
+          "OH", "OK", "OR", "PA", "PR", "SC", "SD", "TN", "TX", "UT", "VA",
+          "VT", "WA", "WI", "WV", "WY"]
+
+DISASTER_TYPES = ["Severe Storm(s)", "Flood", "Hurricane", "Fire", "Tornado",
+                  "Snow", "Severe Ice Storm", "Drought", "Earthquake",
+                  "Coastal Storm", "Mud/Landslide", "Typhoon", "Other"]
+
+DECLARATION_IDS = ["DR", "EM", "FM"]
+
+# Search form combinations, matching the arguments of filter_events()
+SEARCHES = {
+    "all": {},
+    "state": {"state_id": "CA"},
+    "type": {"disaster_type": "Fire"},
+    "declaration": {"declaration_id": "EM"},
+    "year": {"year": "2005"},
+    "month": {"month": "8"},
+    "state+type": {"state_id": "CA", "disaster_type": "Fire"},
+    "state+year": {"state_id": "TX", "year": "2008"},
+    "type+year+month": {"disaster_type": "Flood", "year": "1997",
+                        "month": "3"},
+    "state+type+year+month": {"state_id": "CA", "disaster_type": "Fire",
+                              "year": "2017", "month": "10"},
+}
+
+PAGE_SIZE = 50
+
+
+def synthetic_events(rows, counties_per_incident=20, seed=0):
+    """Yield random Event row dicts shaped like the FEMA declarations"""
+
+    generator = random.Random(seed)
+    first_day = date(1953, 1, 1)
+    days = (date(2018, 12, 31) - first_day).days
+
+    fema_id = 0
+    made = 0
+    while made < rows:
+        fema_id += 1
+        state_id = generator.choice(STATES)
+        disaster_type = generator.choice(DISASTER_TYPES)
+        declaration_id = generator.choice(DECLARATION_IDS)
+        declared_on = first_day + timedelta(days=generator.randrange(days))
+
+        for county in range(generator.randint(1, counties_per_incident * 2)):
+            if made == rows:
+                break
+            made += 1
+            yield {"declaration_id": declaration_id,
+                   "fema_id": fema_id,
+                   "state_id": state_id,
+                   "name": f"{state_id} Synthetic {disaster_type}",
+                   "county": f"County {county}",
+                   "start_date": declared_on - timedelta(days=3),
+                   "end_date": declared_on,
+                   "declared_on": declared_on,
+                   "close_out_date": None,
+                   "disaster_type": disaster_type}
+
+
+def seed_events(rows):
+    """Replace the events table with rows synthetic events"""
+
+    db.drop_all()
+    db.create_all()
+
+    started = time.perf_counter()
+    for batch in batches(synthetic_events(rows)):
+        insert_batch(Event.__table__, EVENT_COLUMNS, batch)
+    incidents.refresh_incidents()
+    db.session.commit()
+    print(f"Seeded {rows} events in {time.perf_counter() - started:.1f}s")
+
+
+def set_indexes(enabled):
+    """Create or drop the Event and Incident indexes declared in model.py"""
+
+    if enabled:
+        create_indexes()
+    else:
+        for table in (Event.__table__, Incident.__table__):
+            for index in table.indexes:
+                db.session.execute(f"DROP INDEX IF EXISTS {index.name}")
+        db.session.commit()
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("ANALYZE events")
+        db.session.execute("ANALYZE incidents")
+        db.session.commit()
+
+
+def search_query(filters, distinct=False):
+    """Build a search over incidents, or over DISTINCT events as before"""
+
+    if distinct:
+        return filter_events(Event.query.distinct('fema_id'), **filters)
+
+    return filter_events(Incident.query, model=Incident, **filters)
+
+
+def run_search(filters, distinct=False):
+    """Run one search the way show_search_results() does"""
+
+    query = search_query(filters, distinct)
+    query.count()
+    query.order_by('fema_id').limit(PAGE_SIZE).all()
+
+
+def percentile(timings, fraction):
+    """Return the value at the given fraction of the sorted timings"""
+
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def benchmark(repeat, explain=False, distinct=False):
+    """Time each search combination and print p50 and p99 in milliseconds"""
+
+    print(f"{'search':<24}{'p50 ms':>10}{'p99 ms':>10}")
+
+    for name, filters in SEARCHES.items():
+        if explain and db.engine.dialect.name == "postgresql":
+            query = search_query(filters, distinct)
+            statement = query.order_by('fema_id').limit(PAGE_SIZE).statement
+            compiled = statement.compile(db.engine,
+                                         compile_kwargs={"literal_binds": True})
+            for line in db.session.execute(f"EXPLAIN {compiled}"):
+                print(f"    {line[0]}")
+
+        run_search(filters, distinct)
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run_search(filters, distinct)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        print(f"{name:<24}{percentile(timings, 0.5):>10.2f}"
+              f"{percentile(timings, 0.99):>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database", default="postgresql:///disasters_bench")
+    parser.add_argument("--rows", type=int, default=3000000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--skip-seed", action="store_true",
+                        help="reuse the events already in the database")
+    parser.add_argument("--no-indexes", action="store_true",
+                        help="drop the Event and Incident indexes first")
+    parser.add_argument("--distinct", action="store_true",
+                        help="search events with DISTINCT, not incidents")
+    parser.add_argument("--explain", action="store_true",
+                        help="print the query plan for each search")
+    args = parser.parse_args()
+
+    connect_to_db(app, args.database)
+
+    with app.app_context():
+        if not args.skip_seed:
+            seed_events(args.rows)
+        set_indexes(not args.no_indexes)
+        benchmark(args.repeat, args.explain, args.distinct)
@@ -0,0 +1,108 @@
+"""Time search-as-you-type lookups against a large synthetic events table
+
+Run from the project root against a scratch database, for example:
+
+    createdb disasters_bench
+    python3 -m benchmarks.search_suggest --rows 3000000
+    python3 -m benchmarks.search_suggest --skip-seed --database postgresql:///disasters
+
+The time to build the prefix index is printed, then the p50 and p99
+latency of /api/search for every prefix of a sample of indexed words,
+both for the index lookup alone and through the Flask route.
+"""
+
+from model import connect_to_db
+from server import app
+from benchmarks.search_indexes import percentile, seed_events
+
+import argparse
+import random
+import time
+
+import searchindex
+
+
+# Suggestions must come back faster than this to feel instant
+TARGET_MS = 10
+
+
+def sample_queries(index, count, seed=0):
+    """Pick queries the way a user types them: each prefix of some words"""
+
+    generator = random.Random(seed)
+    queries = []
+
+    for _ in range(count):
+        word = generator.choice(index.words)
+        queries.extend(word[:length]
+                       for length in range(searchindex.MIN_QUERY_LENGTH,
+                                           len(word) + 1))
+
+        # Sometimes a second word narrows the first one down
+        if generator.random() < 0.3:
+            queries.append(f"{word} {generator.choice(index.words)[:3]}")
+
+    return queries
+
+
+def time_calls(call, queries):
+    """Run call on each query and return the milliseconds each one took"""
+
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        call(query)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    return timings
+
+
+def report(label, timings):
+    """Print p50, p99 and max of timings against the target"""
+
+    p99 = percentile(timings, 0.99)
+    verdict = "ok" if p99 < TARGET_MS else f"over {TARGET_MS} ms"
+    print(f"{label:<12}{percentile(timings, 0.5):>10.3f}{p99:>10.3f}"
+          f"{max(timings):>10.3f}  {verdict}")
+
+
+def benchmark(words):
+    """Build the index, then time lookups directly and through the route"""
+
+    with app.app_context():
+        started = time.perf_counter()
+        index = searchindex.get_index()
+        print(f"Indexed {len(index.incidents)} incidents and "
+              f"{len(index.words)} words in "
+              f"{time.perf_counter() - started:.2f}s")
+
+    queries = sample_queries(index, words)
+    client = app.test_client()
+
+    print(f"{'':<12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+          f"  ({len(queries)} queries)")
+    report("index", time_calls(index.search, queries))
+
+    # Each request gets its own app context, as it would under gunicorn
+    report("route", time_calls(
+        lambda query: client.get("/api/search", query_string={"q": query}),
+        queries))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database", default="postgresql:///disasters_bench")
+    parser.add_argument("--rows", type=int, default=3000000)
+    parser.add_argument("--words", type=int, default=500,
+                        help="number of words whose prefixes are queried")
+    parser.add_argument("--skip-seed", action="store_true",
+                        help="reuse the events already in the database")
+    args = parser.parse_args()
+
+    connect_to_db(app, args.database)
+
+    if not args.skip_seed:
+        with app.app_context():
+            seed_events(args.rows)
+
+    benchmark(args.words)
@@ -0,0 +1,366 @@
+"""Time seeding and every main route on synthetic FEMA data at several scales
+
+Run from the project root. By default each scale is seeded into a
+throwaway SQLite file; pass --database to use a scratch PostgreSQL
+database instead (its tables are dropped and recreated), for example:
+
+    python3 -m benchmarks.suite --scales 1 10 --output before.json
+    createdb disasters_bench
+    python3 -m benchmarks.suite --database postgresql:///disasters_bench \\
+        --output after.json --compare before.json
+
+At 1x the synthetic files are about the size of the real event.txt and
+grant.txt. Each scale times load_events(), load_grants() and the derived
+tables, then each route through the Flask test client with the response
+cache cleared before every request, so the numbers are the database and
+template work rather than cache hits. The results are written as JSON;
+--compare prints the change against an earlier run and exits non-zero
+if anything got slower than --threshold allows.
+"""
+
+from model import Incident, connect_to_db, create_indexes, db
+from pagination import encode_cursor
+from server import app
+from benchmarks.search_indexes import (DECLARATION_IDS, DISASTER_TYPES,
+                                       STATES, percentile)
+
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import funding
+import incidents
+import responsecache
+import seed
+
+
+# Incidents at 1x, about as many as in the FEMA declarations file
+BASE_INCIDENTS = 4500
+
+# Most counties declared in one synthetic incident
+MAX_COUNTIES = 20
+
+# Share of incidents that have a line in grant.txt
+GRANT_SHARE = 0.65
+
+# Routes timed at every scale; {fema_id} and {cursor} are filled in
+ROUTES = {
+    "events_first_page": "/events",
+    "events_deep_page": "/events?cursor={cursor}",
+    "event_detail": "/events/{fema_id}",
+    "search_state": "/search/results?state=CA&disaster-type=all"
+                    "&declaration-id=all&year=&month=",
+    "search_state_type_year": "/search/results?state=TX&disaster-type=Flood"
+                              "&declaration-id=all&year=2008&month=",
+    "search_month": "/search/results?state=all&disaster-type=all"
+                    "&declaration-id=all&year=&month=8",
+    "api_events": "/api/events?state=FL",
+    "api_event": "/api/events/{fema_id}",
+    "api_search": "/api/search?q=cou+fl",
+    "api_geo_state": "/api/geo/state",
+    "funding_state": "/api/funding/state",
+    "export_events_ndjson": "/api/export/events.ndjson?state=CA&year=2005",
+}
+
+
+###############################################################################
+# Synthetic data
+
+
+def field_line(values, trailing=False):
+    """Join values the way the FEMA files are laid out
+
+    grant.txt lines end with a separator and event.txt lines don't.
+    """
+
+    line = "\t|\t".join("" if value is None else str(value)
+                        for value in values)
+
+    return line + ("\t|\t\n" if trailing else "\n")
+
+
+def timestamp(day):
+    """Format a date like the FEMA files do"""
+
+    return f"{day.isoformat()}T00:00:00.000Z"
+
+
+def write_synthetic_files(directory, incidents_count, seed_value=0):
+    """Write event.txt and grant.txt shaped files and return their paths"""
+
+    generator = random.Random(seed_value)
+    first_day = date(1953, 1, 1)
+    days = (date(2018, 12, 31) - first_day).days
+
+    event_path = os.path.join(directory, "event.txt")
+    grant_path = os.path.join(directory, "grant.txt")
+
+    with open(event_path, "w") as event_file, \
+            open(grant_path, "w") as grant_file:
+        for fema_id in range(1, incidents_count + 1):
+            state_id = generator.choice(STATES)
+            disaster_type = generator.choice(DISASTER_TYPES)
+            declaration_id = generator.choice(DECLARATION_IDS)
+            declared_on = first_day + timedelta(days=generator.randrange(days))
+            closed_on = (declared_on + timedelta(days=generator.randrange(2000))
+                         if generator.random() < 0.8 else None)
+
+            for county in range(generator.randint(1, MAX_COUNTIES)):
+                event_file.write(field_line([
+                    declaration_id, fema_id, state_id, state_id,
+                    f"{disaster_type} {fema_id}".upper(),
+                    f"County {county} (County)",
+                    timestamp(declared_on - timedelta(days=3)),
+                    timestamp(declared_on),
+                    timestamp(declared_on),
+                    timestamp(closed_on) if closed_on else None,
+                    disaster_type]))
+
+            if generator.random() < GRANT_SHARE:
+                totals = [round(generator.uniform(1e4, 1e8), 2)
+                          if generator.random() < 0.5 else None
+                          for _ in seed.GRANT_TYPES]
+                grant_file.write(field_line([fema_id, *totals,
+                                             timestamp(date(2018, 8, 5))],
+                                            trailing=True))
+
+    return event_path, grant_path
+
+
+###############################################################################
+# Timing
+
+
+def timed(function, *args, **kwargs):
+    """Run function quietly and return how many seconds it took"""
+
+    started = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        function(*args, **kwargs)
+
+    return time.perf_counter() - started
+
+
+def seed_scale(directory, incidents_count):
+    """Rebuild the database from synthetic files, timing each step"""
+
+    event_path, grant_path = write_synthetic_files(directory, incidents_count)
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    create_indexes()
+    with redirect_stdout(io.StringIO()):
+        seed.load_grant_types()
+        seed.load_centroids()
+
+    timings = {}
+    timings["load_events"] = timed(seed.load_events, event_path)
+    timings["load_grants"] = timed(seed.load_grants, grant_path)
+
+    def refresh():
+        incidents.refresh_incidents()
+        funding.refresh_funding()
+        db.session.commit()
+
+    timings["refresh_incidents_and_funding"] = timed(refresh)
+    timings["record_seed_run"] = timed(seed.record_seed_run)
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("ANALYZE")
+        db.session.commit()
+
+    rows = {table.name: db.session.execute(
+                f"SELECT count(*) FROM {table.name}").scalar()
+            for table in db.metadata.sorted_tables}
+
+    return timings, rows
+
+
+def summarize(timings):
+    """Return the p50, p95, max and mean of timings in milliseconds"""
+
+    return {"p50_ms": percentile(timings, 0.5),
+            "p95_ms": percentile(timings, 0.95),
+            "max_ms": max(timings),
+            "mean_ms": sum(timings) / len(timings),
+            "runs": len(timings)}
+
+
+def time_routes(fema_ids, repeat, seed_value=0):
+    """Time each route through the test client, with a cold page cache
+
+    Call this outside an app context, so each request gets its own as it
+    would under gunicorn.
+    """
+
+    generator = random.Random(seed_value)
+    middle = fema_ids[len(fema_ids) // 2]
+
+    client = app.test_client()
+    results = {}
+
+    for name, template in ROUTES.items():
+        timings = []
+        for run in range(repeat + 1):
+            path = template.format(fema_id=generator.choice(fema_ids),
+                                   cursor=encode_cursor("after", middle))
+            responsecache.clear()
+
+            started = time.perf_counter()
+            response = client.get(path)
+            response.get_data()
+            elapsed = (time.perf_counter() - started) * 1000
+
+            if response.status_code not in (200, 302):
+                raise RuntimeError(f"{path} answered {response.status_code}")
+            # The first run warms up templates and per-seed caches
+            if run:
+                timings.append(elapsed)
+
+        results[name] = summarize(timings)
+        print(f"  {name:<32}{results[name]['p50_ms']:>10.2f}"
+              f"{results[name]['p95_ms']:>10.2f}")
+
+    return results
+
+
+###############################################################################
+# Running and comparing
+
+
+def git_commit():
+    """Return the commit being measured, if this is a git checkout"""
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(scales, repeat):
+    """Seed and time every scale, returning the results as a dict"""
+
+    results = {"started": datetime.utcnow().isoformat(timespec="seconds"),
+               "commit": git_commit(),
+               "python": platform.python_version(),
+               "database": db.engine.dialect.name,
+               "repeat": repeat,
+               "scales": {}}
+
+    directory = tempfile.mkdtemp(prefix="disasters-bench-")
+    try:
+        for scale in scales:
+            incidents_count = int(BASE_INCIDENTS * scale)
+            print(f"{scale}x: {incidents_count} incidents")
+
+            with app.app_context():
+                seeding, rows = seed_scale(directory, incidents_count)
+                fema_ids = [fema_id for fema_id, in db.session.query(
+                    Incident.fema_id).order_by(Incident.fema_id)]
+
+            for step, seconds in seeding.items():
+                print(f"  {step:<32}{seconds:>10.2f}s")
+            print(f"  {'route':<32}{'p50 ms':>10}{'p95 ms':>10}")
+            routes = time_routes(fema_ids, repeat)
+
+            results["scales"][str(scale)] = {
+                "rows": rows,
+                "seed_seconds": seeding,
+                "routes": routes,
+                "max_rss_mb": resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss / 1024}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print each timing against baseline and return the regressions"""
+
+    regressions = []
+    print(f"{'':<44}{'before':>10}{'after':>10}{'change':>9}")
+
+    for scale, measured in results["scales"].items():
+        before = baseline.get("scales", {}).get(scale)
+        if before is None:
+            continue
+
+        pairs = [(f"{scale}x seed {step}", before["seed_seconds"].get(step),
+                  seconds)
+                 for step, seconds in measured["seed_seconds"].items()]
+        pairs += [(f"{scale}x {route} p50",
+                   before["routes"].get(route, {}).get("p50_ms"),
+                   timing["p50_ms"])
+                  for route, timing in measured["routes"].items()]
+
+        for label, old, new in pairs:
+            if not old:
+                continue
+            ratio = new / old
+            flag = "  REGRESSION" if ratio > threshold else ""
+            print(f"{label:<44}{old:>10.2f}{new:>10.2f}"
+                  f"{(ratio - 1) * 100:>8.0f}%{flag}")
+            if flag:
+                regressions.append(label)
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database",
+                        help="scratch database URI (default: a temporary "
+                             "SQLite file)")
+    parser.add_argument("--scales", type=float, nargs="+",
+                        default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="timed requests per route")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="earlier --output file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio that counts as a regression")
+    args = parser.parse_args()
+
+    scratch = None
+    database = args.database
+    if database is None:
+        scratch = tempfile.mkdtemp(prefix="disasters-db-")
+        database = f"sqlite:///{os.path.join(scratch, 'bench.db')}"
+
+    connect_to_db(app, database)
+    # Searches with no results flash a message, which needs a session
+    app.secret_key = app.secret_key or "benchmark"
+
+    try:
+        results = run([scale if scale % 1 else int(scale)
+                       for scale in args.scales], args.repeat)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
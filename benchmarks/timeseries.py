@@ -0,0 +1,145 @@
+"""Time the declaration and funding time series against SQL GROUP BY
+
+Run from the project root. Synthetic incidents at 10x the real files are
+seeded into a throwaway SQLite file like benchmarks.suite does, or an
+existing database is read:
+
+    python3 -m benchmarks.timeseries
+    python3 -m benchmarks.timeseries --database postgresql:///disasters
+
+The snapshot build time is printed, then the p50 and p99 of monthly and
+yearly series for random state and disaster type filters, from the
+snapshot and from a GROUP BY query per series. Every snapshot series is
+checked against the SQL one.
+"""
+
+from model import Incident, IncidentFunding, TOP_LEVEL_GRANT_TYPES
+from model import connect_to_db, db
+from server import app
+from benchmarks.search_indexes import percentile
+from benchmarks.suite import BASE_INCIDENTS, seed_scale
+
+from sqlalchemy import extract, func
+
+import argparse
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import timeseries
+
+
+def sql_series(interval, filters):
+    """Return {bucket: (declarations, funding)} from GROUP BY queries"""
+
+    year = extract("year", Incident.declared_on)
+    month = extract("month", Incident.declared_on)
+    columns = (year,) if interval == "year" else (year, month)
+
+    funding = (db.session.query(IncidentFunding.fema_id,
+                                func.sum(IncidentFunding.total)
+                                .label("total"))
+               .filter(IncidentFunding.grant_type_id
+                       .in_(TOP_LEVEL_GRANT_TYPES))
+               .group_by(IncidentFunding.fema_id).subquery())
+    query = (db.session.query(*columns, func.count(Incident.fema_id),
+                              func.sum(funding.c.total))
+             .outerjoin(funding, funding.c.fema_id == Incident.fema_id)
+             .filter(Incident.declared_on.isnot(None)))
+
+    for name, value in filters.items():
+        query = query.filter(getattr(Incident, name) == value)
+
+    series = {}
+    for row in query.group_by(*columns):
+        *bucket, count, total = row
+        label = (str(int(bucket[0])) if interval == "year"
+                 else f"{int(bucket[0])}-{int(bucket[1]):02d}")
+        series[label] = (count, total or 0.0)
+
+    return series
+
+
+def check(series, expected, filters):
+    """Raise if the snapshot series differs from the SQL one"""
+
+    for bucket, count, total in zip(series["buckets"],
+                                    series["declarations"],
+                                    series["funding"]):
+        expected_count, expected_total = expected.get(bucket, (0, 0.0))
+        if (count != expected_count
+                or not math.isclose(total, expected_total, abs_tol=0.01)):
+            raise AssertionError(f"{bucket} differs for {filters}")
+
+
+def random_filters(snapshot, generator):
+    """Pick a state, a disaster type, both or neither"""
+
+    filters = {}
+    for facet in ("state_id", "disaster_type"):
+        if generator.random() < 0.5:
+            filters[facet] = generator.choice(snapshot.filters.values[facet])
+
+    return filters
+
+
+def run(repeat, seed_value=0):
+    """Build the snapshot, then time and check random series"""
+
+    started = time.perf_counter()
+    snapshot = timeseries.build_snapshot()
+    print(f"{len(snapshot.fema_ids)} incidents, snapshot built in "
+          f"{time.perf_counter() - started:.2f}s")
+
+    generator = random.Random(seed_value)
+
+    for interval in timeseries.INTERVALS:
+        snapshot_ms = []
+        sql_ms = []
+
+        for _ in range(repeat):
+            filters = random_filters(snapshot, generator)
+
+            started = time.perf_counter()
+            series = snapshot.series(interval, filters)
+            snapshot_ms.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            expected = sql_series(interval, filters)
+            sql_ms.append((time.perf_counter() - started) * 1000)
+
+            check(series, expected, filters)
+
+        for name, timings in (("snapshot", snapshot_ms), ("sql", sql_ms)):
+            print(f"  {interval:<6}{name:<10}"
+                  f"p50 {percentile(timings, 0.5):8.3f} ms"
+                  f"   p99 {percentile(timings, 0.99):8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database",
+                        help="database to read (default: seed synthetic "
+                             "data into a temporary SQLite file)")
+    parser.add_argument("--scale", type=float, default=10)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    scratch = None
+    if args.database is None:
+        scratch = tempfile.mkdtemp(prefix="disasters-timeseries-")
+        connect_to_db(app, f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+    else:
+        connect_to_db(app, args.database)
+
+    try:
+        with app.app_context():
+            if scratch:
+                seed_scale(scratch, int(BASE_INCIDENTS * args.scale))
+            run(args.repeat)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
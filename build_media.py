@@ -0,0 +1,152 @@
+"""Build resized, content-hashed WebP/AVIF/JPEG copies of the page images
+
+Run before starting the server, and again whenever an image changes:
+
+    python3 build_media.py
+
+Every JPEG and PNG under static/css/coverr and static/css/photos is
+resized to each of WIDTHS (never upscaled) and saved as WebP, AVIF when
+this Pillow can write it, and JPEG for older browsers. The files go to
+static/build/ with a hash of the source in their names, so they can be
+cached forever, and static/build/manifest.json lists them for media.py.
+Files already built from the same source are reused.
+"""
+
+from PIL import Image, features
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import media
+
+
+SOURCE_DIRECTORIES = ("css/coverr", "css/photos")
+
+SOURCE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Widths in pixels to build, roughly phone, laptop and large desktop
+WIDTHS = (480, 960, 1600)
+
+# Pillow format name, file extension and save options of each output
+FORMATS = {"avif": ("AVIF", "avif", {"quality": 50}),
+           "webp": ("WEBP", "webp", {"quality": 75, "method": 6}),
+           "jpeg": ("JPEG", "jpg", {"quality": 80, "optimize": True,
+                                    "progressive": True})}
+
+
+def source_images(static_folder):
+    """Yield the static-relative paths of every image to build"""
+
+    for directory in SOURCE_DIRECTORIES:
+        for root, _, files in os.walk(os.path.join(static_folder, directory)):
+            for name in sorted(files):
+                if name.lower().endswith(SOURCE_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    yield os.path.relpath(path, static_folder).replace(
+                        os.sep, "/")
+
+
+def content_hash(path):
+    """Return a short hash of a file's bytes"""
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()[:10]
+
+
+def variant_path(source, width, digest, extension):
+    """Return where a variant of source is written, relative to static/"""
+
+    stem = os.path.splitext(source)[0].replace(" ", "_")
+
+    return f"{media.BUILD_DIRECTORY}/{stem}-{width}.{digest}.{extension}"
+
+
+def build_image(static_folder, source, formats):
+    """Write every variant of one image and return its manifest entry"""
+
+    digest = content_hash(os.path.join(static_folder, source))
+
+    with Image.open(os.path.join(static_folder, source)) as original:
+        image = original.convert("RGB")
+
+    width, height = image.size
+    widths = [target for target in WIDTHS if target < width] or [width]
+
+    entry = {"width": width, "height": height, "variants": {}}
+
+    for name in formats:
+        pillow_format, extension, options = FORMATS[name]
+        variants = []
+
+        for target in widths:
+            path = variant_path(source, target, digest, extension)
+            output = os.path.join(static_folder, path)
+
+            if not os.path.exists(output):
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                resized = image.resize(
+                    (target, round(height * target / width)), Image.LANCZOS)
+                resized.save(output, pillow_format, **options)
+
+            variants.append([target, path])
+
+        entry["variants"][name] = variants
+
+    return entry
+
+
+def build(static_folder):
+    """Build every image and write the manifest, returning it"""
+
+    formats = [name for name in FORMATS
+               if name != "avif" or features.check("avif")]
+    if "avif" not in formats:
+        print("This Pillow can't write AVIF, so only WebP and JPEG are built")
+
+    manifest = {}
+    source_bytes = 0
+    smallest_bytes = 0
+
+    for source in source_images(static_folder):
+        started = time.perf_counter()
+        entry = build_image(static_folder, source, formats)
+        manifest[source] = entry
+
+        size = os.path.getsize(os.path.join(static_folder, source))
+        smallest = min(os.path.getsize(os.path.join(static_folder, path))
+                       for variants in entry["variants"].values()
+                       for width, path in variants
+                       if width == variants[-1][0])
+        source_bytes += size
+        smallest_bytes += smallest
+        print(f"{source}: {size / 1024:.0f} kB -> {smallest / 1024:.0f} kB "
+              f"at {entry['variants'][formats[0]][-1][0]}px "
+              f"({time.perf_counter() - started:.1f}s)")
+
+    path = os.path.join(static_folder, media.MANIFEST)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+    if source_bytes:
+        print(f"{len(manifest)} images: {source_bytes / 1e6:.1f} MB of "
+              f"originals, {smallest_bytes / 1e6:.1f} MB at the largest "
+              f"width in the smallest format")
+
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--static", default="static",
+                        help="the app's static folder")
+    args = parser.parse_args()
+
+    build(args.static)
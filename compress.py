@@ -0,0 +1,297 @@
+"""Compressed responses and conditional GETs
+
+init_app() brotli- or gzip-compresses text responses for clients that
+accept it. Bodies under COMPRESS_MIN_SIZE bytes go out as they are, and
+streamed or very large bodies are compressed chunk by chunk as they are
+sent instead of all at once. Every compressed response gets a weak
+ETag, since its bytes differ from the uncompressed page's.
+
+Views wrapped in conditional() get a weak ETag of the page and answer
+If-None-Match with 304 Not Modified.
+"""
+
+from flask import current_app, make_response, request
+from functools import wraps
+
+import hashlib
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import metrics
+
+
+# Content types worth compressing; images and video already are
+COMPRESSIBLE_TYPES = {"application/geo+json", "application/javascript",
+                      "application/json", "application/x-ndjson",
+                      "image/svg+xml", "text/css", "text/csv", "text/html",
+                      "text/javascript", "text/plain"}
+
+# Below this many bytes the headers cost more than compression saves
+MIN_SIZE = 1024
+
+# Bodies above this many bytes are compressed as they are sent
+STREAM_SIZE = 256 * 1024
+
+# Bytes of a buffered body compressed at a time when streaming it
+CHUNK_SIZE = 64 * 1024
+
+# Middle settings: most of the size reduction for little CPU per request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+###############################################################################
+# Negotiation
+
+
+def parse_accept_encoding(header):
+    """Return {coding: quality} from an Accept-Encoding header"""
+
+    qualities = {}
+
+    for part in header.split(","):
+        coding, _, parameters = part.strip().partition(";")
+        if not coding:
+            continue
+
+        quality = 1.0
+        name, _, value = parameters.strip().partition("=")
+        if name.strip() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+
+        qualities[coding.strip().lower()] = quality
+
+    return qualities
+
+
+def choose_encoding(header):
+    """Return "br", "gzip" or None for an Accept-Encoding header
+
+    Brotli wins ties, since it makes smaller pages at the same speed.
+    """
+
+    qualities = parse_accept_encoding(header or "")
+    available = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    best, best_quality = None, 0.0
+    for coding in available:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+
+    return best
+
+
+###############################################################################
+# Compression
+
+
+class Compressor(object):
+    """Incremental brotli or gzip compression of one response body"""
+
+    def __init__(self, encoding, level=None):
+        self.encoding = encoding
+
+        if encoding == "br":
+            engine = brotli.Compressor(quality=level or BROTLI_QUALITY)
+            self._compress = engine.process
+            self._flush = engine.flush
+            self._finish = engine.finish
+        else:
+            engine = zlib.compressobj(level or GZIP_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+            self._compress = engine.compress
+            self._flush = lambda: engine.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = engine.flush
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def _timed(self, function, *args):
+        """Run one compression step, adding up its time and output"""
+
+        started = time.perf_counter()
+        output = function(*args)
+        self.seconds += time.perf_counter() - started
+        self.bytes_out += len(output)
+
+        return output
+
+    def compress(self, data):
+        """Compress data, returning whatever output is ready"""
+
+        self.bytes_in += len(data)
+        return self._timed(self._compress, data)
+
+    def flush(self):
+        """Return everything compressed so far, so the client can use it"""
+
+        return self._timed(self._flush)
+
+    def finish(self):
+        """Return the end of the compressed body"""
+
+        return self._timed(self._finish)
+
+    def record(self):
+        """Add the bytes and time of this body to the metrics"""
+
+        metrics.COMPRESSED_BYTES.inc(self.bytes_in, encoding=self.encoding,
+                                     stage="in")
+        metrics.COMPRESSED_BYTES.inc(self.bytes_out, encoding=self.encoding,
+                                     stage="out")
+        metrics.COMPRESSION_SECONDS.inc(self.seconds,
+                                        encoding=self.encoding)
+
+
+def compress_body(encoding, body, level=None):
+    """Return body compressed in one go"""
+
+    compressor = Compressor(encoding, level)
+    compressed = compressor.compress(body) + compressor.finish()
+    compressor.record()
+
+    return compressed
+
+
+def compress_chunks(encoding, chunks, flush=False, level=None):
+    """Compress an iterable of byte strings as it is read
+
+    With flush, the output of each chunk is sent before the next is read,
+    so slow streams like the exports reach the client as they're made.
+    """
+
+    compressor = Compressor(encoding, level)
+
+    try:
+        for chunk in chunks:
+            output = compressor.compress(chunk)
+            if flush:
+                output += compressor.flush()
+            if output:
+                yield output
+
+        yield compressor.finish()
+    finally:
+        compressor.record()
+
+
+def slices(body, size=CHUNK_SIZE):
+    """Yield body size bytes at a time"""
+
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+###############################################################################
+# Hooks and views
+
+
+def should_compress(response):
+    """Check that the response is a text body nobody has encoded yet"""
+
+    return (request.method != "HEAD"
+            and 200 <= response.status_code < 300
+            and response.status_code not in (204, 206)
+            and "Content-Encoding" not in response.headers
+            and response.mimetype in COMPRESSIBLE_TYPES)
+
+
+def weaken_etag(response):
+    """Mark a strong ETag weak, as the compressed bytes differ from it"""
+
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    """Compress the response if the client accepts brotli or gzip"""
+
+    if not should_compress(response):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # The server closes the response, which must still close the stream
+        stream = response.response
+        if hasattr(stream, "close"):
+            response.call_on_close(stream.close)
+
+        response.response = compress_chunks(encoding,
+                                            response.iter_encoded(),
+                                            flush=True)
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        response.direct_passthrough = False
+        body = response.get_data()
+        if len(body) < current_app.config.get("COMPRESS_MIN_SIZE", MIN_SIZE):
+            return response
+
+        if len(body) > current_app.config.get("COMPRESS_STREAM_SIZE",
+                                              STREAM_SIZE):
+            response.response = compress_chunks(encoding, slices(body))
+            response.headers.pop("Content-Length", None)
+        else:
+            compressed = compress_body(encoding, body)
+            if len(compressed) >= len(body):
+                return response
+            response.set_data(compressed)
+
+    response.headers["Content-Encoding"] = encoding
+    weaken_etag(response)
+
+    return response
+
+
+def conditional(view):
+    """Give the view's pages a weak ETag and answer If-None-Match with 304
+
+    Pages that already have an ETag, like the response cache's, keep it.
+    """
+
+    @wraps(view)
+    def conditional_view(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+
+        if (request.method not in ("GET", "HEAD")
+                or response.status_code != 200 or response.is_streamed):
+            return response
+
+        if response.get_etag()[0] is None:
+            response.set_etag(hashlib.md5(response.get_data()).hexdigest(),
+                              weak=True)
+        if not response.cache_control:
+            # Browsers may keep the page, but must check it's still current
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+
+        return response.make_conditional(request)
+
+    return conditional_view
+
+
+def init_app(app):
+    """Compress the responses app sends
+
+    Call this before other after_request hooks are added, so the body is
+    compressed after they have changed it. COMPRESS_MIN_SIZE and
+    COMPRESS_STREAM_SIZE in app.config override the sizes above.
+    """
+
+    app.after_request(compress_response)
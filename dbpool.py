@@ -0,0 +1,195 @@
+"""Connection pool settings, pool metrics and read-replica routing"""
+
+from flask import g, has_request_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from functools import wraps
+
+import os
+import threading
+import time
+
+
+# Pool settings used when neither app.config nor the environment set them
+POOL_DEFAULTS = {"size": 5,
+                 "overflow": 10,
+                 "timeout": 30,
+                 "recycle": 1800,
+                 "statement_timeout": 0}
+
+REPLICA = "replica"
+
+# Live pool of each engine by label, for pool_stats()
+pools = {}
+
+
+###############################################################################
+# Pool profile
+
+
+def pool_profile(app, overrides=None):
+    """Return the pool settings for app
+
+    Each setting is read from app.config, then the environment, under
+    DB_POOL_<NAME> (e.g. DB_POOL_SIZE, DB_POOL_STATEMENT_TIMEOUT in
+    milliseconds), falling back to POOL_DEFAULTS. Values passed in
+    overrides win over both.
+    """
+
+    profile = dict(POOL_DEFAULTS)
+
+    for name in profile:
+        key = f"DB_POOL_{name.upper()}"
+        value = app.config.get(key, os.environ.get(key))
+        if value is not None:
+            profile[name] = int(value)
+
+    profile.update(overrides or {})
+
+    return profile
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection
+
+    A pool is listed in pools under the label it is created with. Pools
+    that recreate() builds get no label from QueuePool, so they are
+    listed there once the old pool's label is copied over.
+    """
+
+    def __init__(self, creator, label=None, **kwargs):
+        super().__init__(creator, **kwargs)
+        self.label = label or "primary"
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.stats_lock = threading.Lock()
+        if label is not None:
+            pools[label] = self
+
+    def _do_get(self):
+        """Check out a connection, timing the wait"""
+
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def recreate(self):
+        """Replace the pool after dispose(), keeping its label"""
+
+        pool = super().recreate()
+        pool.label = self.label
+        pools[self.label] = pool
+
+        return pool
+
+    def stats(self):
+        """Return checkout wait times and how full the pool is"""
+
+        checked_out = self.checkedout()
+        capacity = self.size() + max(self._max_overflow, 0)
+
+        with self.stats_lock:
+            return {"size": self.size(),
+                    "checked_out": checked_out,
+                    "capacity": capacity,
+                    "saturation": checked_out / capacity if capacity else 0,
+                    "checkouts": self.checkouts,
+                    "timeouts": self.timeouts,
+                    "wait_seconds_total": self.wait_total,
+                    "wait_seconds_max": self.wait_max}
+
+
+def pool_stats():
+    """Return the stats of every pool by label"""
+
+    return {label: pool.stats() for label, pool in pools.items()}
+
+
+###############################################################################
+# Engines and sessions
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads from read_only routes to the replica"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        """Use the replica engine while a read_only route is running"""
+
+        binds = self.app.config.get("SQLALCHEMY_BINDS") or {}
+
+        if (has_request_context() and g.get("use_replica")
+                and not self._flushing and REPLICA in binds):
+            return self.db.get_engine(self.app, bind=REPLICA)
+
+        return super().get_bind(mapper, clause)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with pre-ping, a tuned pool and an optional replica"""
+
+    def create_session(self, options):
+        """Make sessions that can route reads to the replica"""
+
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        """Add the pool profile to the options of each engine"""
+
+        rv = super().apply_driver_hacks(app, sa_url, options)
+
+        # Connections that died while idle are replaced instead of failing
+        options["pool_pre_ping"] = True
+
+        if sa_url.drivername.startswith("sqlite"):
+            return rv
+
+        profile = pool_profile(app, app.config.get("DB_POOL"))
+        replica = (app.config.get("SQLALCHEMY_BINDS") or {}).get(REPLICA)
+        is_replica = replica is not None and sa_url == make_url(replica)
+
+        options.update(poolclass=TimedQueuePool,
+                       label=REPLICA if is_replica else "primary",
+                       pool_size=profile["size"],
+                       max_overflow=profile["overflow"],
+                       pool_timeout=profile["timeout"],
+                       pool_recycle=profile["recycle"])
+
+        if profile["statement_timeout"] and sa_url.drivername.startswith(
+                "postgresql"):
+            options.setdefault("connect_args", {})["options"] = (
+                f"-c statement_timeout={profile['statement_timeout']}")
+
+        return rv
+
+
+def read_only(view):
+    """Send the view's queries to the read replica when one is configured"""
+
+    @wraps(view)
+    def replica_view(*args, **kwargs):
+        g.use_replica = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.use_replica = False
+
+    return replica_view
@@ -0,0 +1,141 @@
+"""Plain data versions of incidents, events and grants for the JSON API
+
+The bulk exports stream rows straight from a server-side cursor, a batch
+at a time, so their memory use stays the same however many rows match.
+"""
+
+from model import Event, Grant, GrantType, db
+
+from itertools import islice
+
+import csv
+import io
+import json
+
+
+FORMATS = {"ndjson": "application/x-ndjson",
+           "csv": "text/csv"}
+
+# Rows fetched from the cursor and written out together
+EXPORT_BATCH = 1000
+
+INCIDENT_FIELDS = ("fema_id", "declaration_id", "state_id", "name",
+                   "start_date", "end_date", "declared_on", "close_out_date",
+                   "disaster_type", "county_count")
+
+EVENT_FIELDS = ("id", "declaration_id", "fema_id", "state_id", "name",
+                "county", "start_date", "end_date", "declared_on",
+                "close_out_date", "disaster_type")
+
+
+def json_value(value):
+    """Turn dates into ISO strings and leave everything else alone"""
+
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def incident_dict(incident):
+    """Return an Incident and its funding totals as a dict"""
+
+    data = {field: json_value(getattr(incident, field))
+            for field in INCIDENT_FIELDS}
+    data["funding"] = [{"grant": funding.grant_type.name,
+                        "total": funding.total}
+                       for funding in incident.grants]
+
+    return data
+
+
+def event_dict(event):
+    """Return an Event and its grants as a dict"""
+
+    data = {field: json_value(getattr(event, field))
+            for field in EVENT_FIELDS}
+    data["grants"] = [{"id": grant.id,
+                       "grant": grant.grant_type.name,
+                       "total": grant.total}
+                      for grant in event.grants]
+
+    return data
+
+
+###############################################################################
+# Bulk exports
+
+
+def export_query(table):
+    """Return (query, field names) for every row of an export
+
+    The query selects plain columns, not model objects, and filter_by()
+    on it filters events, so the search form filters apply to both.
+    """
+
+    if table == "events":
+        columns = [getattr(Event, field) for field in EVENT_FIELDS]
+        query = db.session.query(*columns).order_by(Event.id)
+        return query, EVENT_FIELDS
+
+    fields = ("id", "event_id", "fema_id", "grant", "total")
+    query = db.session.query(Grant.id,
+                             Grant.event_id,
+                             Event.fema_id,
+                             GrantType.name,
+                             Grant.total
+                             ).join(Grant.grant_type
+                             ).join(Grant.event
+                             ).order_by(Grant.id)
+
+    return query, fields
+
+
+def stream_rows(query):
+    """Run query on a server-side cursor and return its rows as they come
+
+    The query runs right away, so it uses the connection of the route
+    that called this, and rows are then fetched EXPORT_BATCH at a time.
+    """
+
+    return iter(query.yield_per(EXPORT_BATCH))
+
+
+def row_batches(rows):
+    """Yield lists of up to EXPORT_BATCH rows"""
+
+    while True:
+        batch = list(islice(rows, EXPORT_BATCH))
+        if not batch:
+            return
+        yield batch
+
+
+def ndjson_chunks(rows, fields):
+    """Yield the rows as JSON lines, one batch per chunk"""
+
+    for batch in row_batches(rows):
+        yield "".join(json.dumps(dict(zip(fields, map(json_value, row))))
+                      + "\n" for row in batch)
+
+
+def csv_chunks(rows, fields):
+    """Yield a CSV header and then the rows, one batch per chunk"""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(fields)
+    yield buffer.getvalue()
+
+    for batch in row_batches(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+
+def export_chunks(fmt, rows, fields):
+    """Yield the text of an export in the given format"""
+
+    if fmt == "csv":
+        return csv_chunks(rows, fields)
+
+    return ndjson_chunks(rows, fields)
@@ -0,0 +1,196 @@
+"""Declaration counts for every search filter value, from a columnar snapshot
+
+The state, disaster type, declaration type, year and month of every
+incident are loaded once per seed run into NumPy arrays of small integer
+codes, one array per filter, with the distinct values of each filter in a
+list the codes index. Counting the declarations that match any mix of
+filters is then a few vectorized comparisons and one bincount per filter,
+with no SQL at all.
+"""
+
+from model import Incident, db
+
+import threading
+
+import numpy as np
+
+import stats
+
+
+# The search filters, named as in filter_events()
+FACETS = ("state_id", "disaster_type", "declaration_id", "year", "month")
+
+# Filter values that mean "don't filter", as the search form sends them
+UNFILTERED = (None, "", "all")
+
+_lock = threading.Lock()
+_cache = {}
+
+
+class Snapshot(object):
+    """Dictionary-encoded filter columns of every incident"""
+
+    def __init__(self, columns):
+        """Encode columns, {facet: [value of each incident, ...]}
+
+        Values are kept as the search form sends them, so "2005" rather
+        than 2005. None is given a code of its own that is never counted.
+        """
+
+        self.size = len(columns[FACETS[0]])
+        self.values = {}
+        self.lookups = {}
+        self.codes = {}
+
+        for facet in FACETS:
+            values = sorted({value for value in columns[facet]
+                             if value is not None})
+            lookup = {value: code for code, value in enumerate(values)}
+            missing = len(values)
+
+            dtype = np.int16 if missing < np.iinfo(np.int16).max else np.int32
+            self.values[facet] = values
+            self.lookups[facet] = lookup
+            self.codes[facet] = np.fromiter(
+                (lookup.get(value, missing) for value in columns[facet]),
+                dtype=dtype, count=self.size)
+
+        # The search page opens with no filters, so count that case now
+        self.unfiltered = {facet: self.totals(facet, None)
+                           for facet in FACETS}
+
+    def totals(self, facet, rows):
+        """Count the incidents at rows with each value of facet"""
+
+        codes = self.codes[facet]
+        if rows is not None:
+            codes = codes.take(rows)
+
+        values = self.values[facet]
+        totals = np.bincount(codes, minlength=len(values) + 1)
+
+        return {value: int(total)
+                for value, total in zip(values, totals) if total}
+
+    def mask(self, facet, value):
+        """Return a boolean array of the incidents where facet is value"""
+
+        code = self.lookups[facet].get(value)
+        if code is None:
+            return np.zeros(self.size, dtype=bool)
+
+        return self.codes[facet] == code
+
+    def matching(self, filters):
+        """Return a boolean array of the incidents matching every filter"""
+
+        selected = np.ones(self.size, dtype=bool)
+        for facet, value in filters.items():
+            if facet in FACETS and value not in UNFILTERED:
+                selected &= self.mask(facet, value)
+
+        return selected
+
+    def counts(self, filters):
+        """Count matching incidents, and per value of each facet
+
+        Each facet is counted with every filter applied but its own, so
+        the counts say how many declarations picking that value would give.
+        """
+
+        masks = {facet: self.mask(facet, value)
+                 for facet, value in filters.items()
+                 if facet in FACETS and value not in UNFILTERED}
+
+        # Facets nobody filtered on are all counted at the matching rows,
+        # found once; filters usually leave few, so take() beats a mask
+        matching = None
+        if masks:
+            matching = np.flatnonzero(np.logical_and.reduce(
+                list(masks.values())))
+
+        facets = {}
+        for facet in FACETS:
+            rows = matching
+            if facet in masks:
+                others = [mask for name, mask in masks.items()
+                          if name != facet]
+                rows = (np.flatnonzero(np.logical_and.reduce(others))
+                        if others else None)
+
+            if rows is None:
+                facets[facet] = dict(self.unfiltered[facet])
+            else:
+                facets[facet] = self.totals(facet, rows)
+
+        total = self.size if matching is None else len(matching)
+
+        return {"total": total, "facets": facets}
+
+
+def form_value(value):
+    """Turn a column value into the string the search form sends"""
+
+    return None if value is None else str(value)
+
+
+def filter_columns(rows):
+    """Split incident rows into the {facet: [value, ...]} columns to encode
+
+    Rows are (state_id, disaster_type, declaration_id, declared_on).
+    """
+
+    columns = {facet: [] for facet in FACETS}
+    for state_id, disaster_type, declaration_id, declared_on in rows:
+        columns["state_id"].append(state_id)
+        columns["disaster_type"].append(disaster_type)
+        columns["declaration_id"].append(declaration_id)
+        columns["year"].append(form_value(declared_on and declared_on.year))
+        columns["month"].append(form_value(declared_on and declared_on.month))
+
+    return columns
+
+
+def build_snapshot():
+    """Load the filter columns of every incident into a Snapshot"""
+
+    rows = db.session.query(Incident.state_id, Incident.disaster_type,
+                            Incident.declaration_id, Incident.declared_on)
+
+    return Snapshot(filter_columns(rows))
+
+
+def get_snapshot():
+    """Return the snapshot of the current data, rebuilding it after a reseed"""
+
+    version = stats.data_version()
+
+    with _lock:
+        if _cache.get("version") == version and "snapshot" in _cache:
+            return _cache["snapshot"]
+
+    snapshot = build_snapshot()
+
+    with _lock:
+        _cache["version"] = version
+        _cache["snapshot"] = snapshot
+
+    return snapshot
+
+
+def invalidate():
+    """Drop the snapshot so the next lookup rebuilds it"""
+
+    with _lock:
+        _cache.clear()
+
+
+def counts(state_id="all", disaster_type="all", declaration_id="all",
+           year=None, month=None):
+    """Count the declarations matching the filters, and per filter value"""
+
+    return get_snapshot().counts({"state_id": state_id,
+                                  "disaster_type": disaster_type,
+                                  "declaration_id": declaration_id,
+                                  "year": year,
+                                  "month": month})
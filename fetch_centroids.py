@@ -0,0 +1,67 @@
+"""Download the Census counties gazetteer for placing counties on the map
+
+Run once before seeding, or let seed.py run it when the file is missing:
+
+    python3 fetch_centroids.py
+
+The gazetteer zip is downloaded from the Census Bureau and its one text
+file is written to seed_data/county_centroids.txt unchanged, so it can
+be committed and rebuilt the same way for a newer year. It is tab
+separated with a header row, and seed.load_centroids() reads the USPS,
+NAME, INTPTLAT and INTPTLONG columns.
+"""
+
+from urllib.request import urlopen
+
+import argparse
+import io
+import zipfile
+
+
+GAZETTEER_URL = ("https://www2.census.gov/geo/docs/maps-data/data/gazetteer/"
+                 "2018_Gazetteer/2018_Gaz_counties_national.zip")
+
+COUNTIES_PATH = "seed_data/county_centroids.txt"
+
+
+def write_counties(archive, path=COUNTIES_PATH):
+    """Write the gazetteer text file from a zip archive to path
+
+    archive is a path or a binary file object. Older gazetteer years are
+    Latin-1 rather than UTF-8, so both are read. Returns the number of
+    counties written.
+    """
+
+    with zipfile.ZipFile(archive) as gazetteer:
+        name, = [name for name in gazetteer.namelist()
+                 if name.endswith(".txt")]
+        raw = gazetteer.read(name)
+
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        text = raw.decode("latin-1")
+
+    with open(path, "w", encoding="utf-8") as counties_file:
+        counties_file.write(text)
+
+    return len(text.splitlines()) - 1
+
+
+def fetch_counties(path=COUNTIES_PATH, url=GAZETTEER_URL):
+    """Download the gazetteer and write its counties to path"""
+
+    with urlopen(url, timeout=60) as response:
+        archive = io.BytesIO(response.read())
+
+    return write_counties(archive, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=GAZETTEER_URL)
+    parser.add_argument("--output", default=COUNTIES_PATH)
+    args = parser.parse_args()
+
+    print(f"Wrote {fetch_counties(args.output, args.url)} counties "
+          f"to {args.output}")
@@ -0,0 +1,233 @@
+"""Precomputed funding totals per incident and per state, type, year and county"""
+
+from sqlalchemy import func, tuple_
+from model import Event, FundingRollup, Grant, GrantType, IncidentFunding, db
+
+
+DIMENSIONS = ("state", "disaster_type", "year", "county")
+
+# Most values bound into one IN (...) clause
+CHUNK_SIZE = 500
+
+# FEMA reports funding per incident, not per county, so a county's total
+# is the whole funding of each incident that touched it
+COUNTY_NOTE = ("County totals are the full funding of every incident that "
+               "touched the county, so incidents spanning several counties "
+               "count in each and county totals add up to more than state "
+               "totals.")
+
+
+def chunks(values, size=CHUNK_SIZE):
+    """Split a list into lists of at most size values"""
+
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+def county_key(state_id, county):
+    """Key a county by its state, since county names repeat across states"""
+
+    return f"{state_id}|{county}"
+
+
+###############################################################################
+# Building the tables
+
+
+def incident_totals(fema_ids=None):
+    """Total each incident's grants by type
+
+    load_grants() copies an incident's grants onto each of its county rows,
+    so the incident total is the amount on any one row, not their sum.
+    """
+
+    query = db.session.query(Event.fema_id,
+                             Grant.grant_type_id,
+                             func.max(Grant.total),
+                             func.min(Event.state_id),
+                             func.min(Event.disaster_type),
+                             func.min(Event.declared_on)
+                             ).join(Event.grants
+                             ).group_by(Event.fema_id, Grant.grant_type_id)
+
+    if fema_ids is not None:
+        query = query.filter(Event.fema_id.in_(fema_ids))
+
+    return [{"fema_id": fema_id,
+             "grant_type_id": grant_type_id,
+             "total": total,
+             "state_id": state_id,
+             "disaster_type": disaster_type,
+             "year": declared_on.year if declared_on else None}
+            for fema_id, grant_type_id, total, state_id, disaster_type,
+                declared_on in query]
+
+
+def rollup_query(dimension):
+    """Return (query, key columns) summing incident funding by dimension
+
+    Each incident counts once per state, type and year. For counties it
+    counts in full toward every county it touched, as COUNTY_NOTE says,
+    since FEMA does not say how the money was split between them.
+    """
+
+    totals = (func.sum(IncidentFunding.total),
+              func.count(IncidentFunding.fema_id))
+
+    if dimension == "county":
+        counties = db.session.query(Event.fema_id,
+                                    Event.state_id,
+                                    Event.county).distinct().subquery()
+        columns = (counties.c.state_id, counties.c.county)
+        query = db.session.query(*columns, IncidentFunding.grant_type_id,
+                                 *totals
+                                 ).join(IncidentFunding,
+                                        IncidentFunding.fema_id
+                                        == counties.c.fema_id)
+    else:
+        column = {"state": IncidentFunding.state_id,
+                  "disaster_type": IncidentFunding.disaster_type,
+                  "year": IncidentFunding.year}[dimension]
+        columns = (column,)
+        query = db.session.query(column, IncidentFunding.grant_type_id,
+                                 *totals)
+
+    query = query.filter(*[column.isnot(None) for column in columns]
+                         ).group_by(*columns, IncidentFunding.grant_type_id)
+
+    return query, columns
+
+
+def rollups(dimension, keys=None):
+    """Compute rollup rows for dimension, limited to keys if given"""
+
+    query, columns = rollup_query(dimension)
+
+    if keys is None:
+        queries = [query]
+    elif dimension == "county":
+        pairs = [tuple(key.split("|", 1)) for key in keys]
+        queries = [query.filter(tuple_(*columns).in_(chunk))
+                   for chunk in chunks(pairs)]
+    else:
+        values = [int(key) if dimension == "year" else key for key in keys]
+        queries = [query.filter(columns[0].in_(chunk))
+                   for chunk in chunks(values)]
+
+    rows = []
+    for query in queries:
+        for *values, grant_type_id, total, incidents in query:
+            key = county_key(*values) if dimension == "county" else values[0]
+            rows.append({"dimension": dimension,
+                         "key": str(key),
+                         "grant_type_id": grant_type_id,
+                         "total": total,
+                         "incidents": incidents})
+
+    return rows
+
+
+def rollup_keys(fema_ids):
+    """Find the rollup keys that the given incidents count toward"""
+
+    keys = {dimension: set() for dimension in DIMENSIONS}
+
+    for chunk in chunks(fema_ids):
+        for state_id, disaster_type, year in db.session.query(
+                IncidentFunding.state_id,
+                IncidentFunding.disaster_type,
+                IncidentFunding.year
+                ).filter(IncidentFunding.fema_id.in_(chunk)).distinct():
+            keys["state"].add(state_id)
+            keys["disaster_type"].add(disaster_type)
+            keys["year"].add(year)
+
+        counties = db.session.query(Event.state_id, Event.county
+                                    ).filter(Event.fema_id.in_(chunk)
+                                    ).distinct()
+        for state_id, county in counties:
+            if state_id is not None and county is not None:
+                keys["county"].add(county_key(state_id, county))
+
+    return {dimension: sorted(str(key) for key in values if key is not None)
+            for dimension, values in keys.items()}
+
+
+def insert_rows(model, rows):
+    """Bulk insert row dicts into the model's table"""
+
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+
+
+def refresh_funding(fema_ids=None):
+    """Rebuild the funding tables, or only what the given incidents touch
+
+    Nothing is committed, so a reseed can refresh the totals in the same
+    transaction that changed the events and grants.
+    """
+
+    if fema_ids is None:
+        IncidentFunding.query.delete()
+        FundingRollup.query.delete()
+        insert_rows(IncidentFunding, incident_totals())
+        for dimension in DIMENSIONS:
+            insert_rows(FundingRollup, rollups(dimension))
+        return
+
+    fema_ids = sorted(fema_ids)
+    if not fema_ids:
+        return
+
+    # Keys the incidents counted toward before and after the change
+    keys = rollup_keys(fema_ids)
+
+    for chunk in chunks(fema_ids):
+        IncidentFunding.query.filter(IncidentFunding.fema_id.in_(chunk)
+                                     ).delete(synchronize_session=False)
+        insert_rows(IncidentFunding, incident_totals(chunk))
+
+    for dimension, values in rollup_keys(fema_ids).items():
+        keys[dimension] = sorted(set(keys[dimension]) | set(values))
+
+    for dimension in DIMENSIONS:
+        for chunk in chunks(keys[dimension]):
+            FundingRollup.query.filter(FundingRollup.dimension == dimension,
+                                       FundingRollup.key.in_(chunk)
+                                       ).delete(synchronize_session=False)
+        insert_rows(FundingRollup, rollups(dimension, keys[dimension]))
+
+
+###############################################################################
+# Reading the tables
+
+
+def get_rollups(dimension, key=None, grant=None):
+    """Return the funding totals for dimension as dicts"""
+
+    query = db.session.query(FundingRollup, GrantType.name
+                             ).join(GrantType
+                             ).filter(FundingRollup.dimension == dimension)
+
+    if key is not None:
+        query = query.filter(FundingRollup.key == key)
+    if grant is not None:
+        query = query.filter(GrantType.name == grant)
+
+    return [{"key": rollup.key,
+             "grant": grant_name,
+             "total": rollup.total,
+             "incidents": rollup.incidents}
+            for rollup, grant_name in query.order_by(FundingRollup.key,
+                                                     GrantType.id)]
+
+
+def get_incident_funding(fema_id):
+    """Return the funding totals of one incident as dicts"""
+
+    query = db.session.query(GrantType.name, IncidentFunding.total
+                             ).join(GrantType
+                             ).filter(IncidentFunding.fema_id == fema_id
+                             ).order_by(GrantType.id)
+
+    return [{"grant": grant_name, "total": total}
+            for grant_name, total in query]
@@ -0,0 +1,192 @@
+"""Incident counts and funding per state and county, placed for the map
+
+Regions are placed on their centroid from the centroids table, which
+seed.py loads from local files, so drawing the map never calls Google.
+The features of each level are built once per seed run and kept here.
+"""
+
+from sqlalchemy import distinct, func
+from model import Centroid, Event, FundingRollup, GrantType, Incident, db
+from model import TOP_LEVEL_GRANT_TYPES
+
+import re
+import threading
+
+import stats
+
+
+LEVELS = ("state", "county")
+
+FORMATS = ("geojson", "columns")
+
+# Decimal places kept in coordinates, about 10 m
+COORDINATE_PLACES = 4
+
+# Endings that FEMA and the Census spell differently, e.g. "Butte (County)"
+# in FEMA's designated areas is "Butte County" in the Census gazetteer
+COUNTY_SUFFIXES = re.compile(r"\s+(county|parish|borough|census area|"
+                             r"municipio|municipality|city and borough)$")
+
+_lock = threading.Lock()
+_cache = {}
+
+
+def county_key(name):
+    """Reduce a county name to the form FEMA and the Census agree on"""
+
+    key = re.sub(r"[()]", " ", (name or "").lower())
+    key = " ".join(key.replace("independent city", "city").split())
+
+    return COUNTY_SUFFIXES.sub("", key)
+
+
+###############################################################################
+# Building the regions
+
+
+def incident_counts(level):
+    """Count incidents per (state_id, county key)"""
+
+    if level == "state":
+        rows = db.session.query(Incident.state_id,
+                                func.count(Incident.fema_id)
+                                ).group_by(Incident.state_id)
+        return {(state_id, ""): count for state_id, count in rows}
+
+    rows = db.session.query(Event.state_id, Event.county,
+                            func.count(distinct(Event.fema_id))
+                            ).filter(Event.county.isnot(None)
+                            ).group_by(Event.state_id, Event.county)
+
+    counts = {}
+    for state_id, county, count in rows:
+        region = (state_id, county_key(county))
+        counts[region] = counts.get(region, 0) + count
+
+    return counts
+
+
+def funding_totals(level, grant=None):
+    """Total the precomputed funding rollups per (state_id, county key)
+
+    With no grant, only the top-level dollar grant types are added up.
+    County totals overlap, see funding.COUNTY_NOTE.
+    """
+
+    query = db.session.query(FundingRollup.key, func.sum(FundingRollup.total)
+                             ).filter(FundingRollup.dimension == level
+                             ).group_by(FundingRollup.key)
+
+    if grant is not None:
+        query = query.join(GrantType).filter(GrantType.name == grant)
+    else:
+        query = query.filter(
+            FundingRollup.grant_type_id.in_(TOP_LEVEL_GRANT_TYPES))
+
+    totals = {}
+    for key, total in query:
+        state_id, _, county = key.partition("|")
+        region = (state_id, county_key(county))
+        totals[region] = totals.get(region, 0) + total
+
+    return totals
+
+
+def regions(level, grant=None):
+    """Return (placed regions, number of regions with no centroid)"""
+
+    counts = incident_counts(level)
+    totals = funding_totals(level, grant)
+
+    query = Centroid.query
+    if level == "state":
+        query = query.filter(Centroid.county == "")
+    else:
+        query = query.filter(Centroid.county != "")
+    centroids = {(centroid.state_id, centroid.county): centroid
+                 for centroid in query}
+
+    placed = []
+    unplaced = 0
+    for region in sorted(set(counts) | set(totals),
+                         key=lambda region: (region[0] or "", region[1])):
+        centroid = centroids.get(region)
+        if centroid is None:
+            unplaced += 1
+            continue
+
+        placed.append({"id": "|".join(region) if region[1] else region[0],
+                       "name": centroid.name,
+                       "latitude": round(centroid.latitude,
+                                         COORDINATE_PLACES),
+                       "longitude": round(centroid.longitude,
+                                          COORDINATE_PLACES),
+                       "incidents": counts.get(region, 0),
+                       "funding": round(totals.get(region, 0))})
+
+    return placed, unplaced
+
+
+###############################################################################
+# Output formats
+
+
+def as_geojson(placed, unplaced):
+    """Return the regions as a GeoJSON FeatureCollection of points"""
+
+    features = [{"type": "Feature",
+                 "geometry": {"type": "Point",
+                              "coordinates": [region["longitude"],
+                                              region["latitude"]]},
+                 "properties": {"id": region["id"],
+                                "name": region["name"],
+                                "incidents": region["incidents"],
+                                "funding": region["funding"]}}
+                for region in placed]
+
+    return {"type": "FeatureCollection",
+            "features": features,
+            "unplaced": unplaced}
+
+
+def as_columns(placed, unplaced):
+    """Return the regions as column names and rows, about half the size"""
+
+    columns = ("id", "name", "longitude", "latitude", "incidents", "funding")
+
+    return {"columns": columns,
+            "rows": [[region[column] for column in columns]
+                     for region in placed],
+            "unplaced": unplaced}
+
+
+def get_regions(level, grant=None, fmt="geojson"):
+    """Return the regions of level in fmt, rebuilding them after a reseed"""
+
+    key = (level, grant, fmt)
+    version = stats.data_version()
+
+    with _lock:
+        if _cache.get("version") == version and key in _cache:
+            return _cache[key]
+
+    placed, unplaced = regions(level, grant)
+    if fmt == "columns":
+        data = as_columns(placed, unplaced)
+    else:
+        data = as_geojson(placed, unplaced)
+
+    with _lock:
+        if _cache.get("version") != version:
+            _cache.clear()
+            _cache["version"] = version
+        _cache[key] = data
+
+    return data
+
+
+def invalidate():
+    """Drop the cached regions so the next lookup rebuilds them"""
+
+    with _lock:
+        _cache.clear()
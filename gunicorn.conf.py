@@ -0,0 +1,31 @@
+"""Gunicorn settings for serving the app in production
+
+Send the master SIGHUP (systemctl reload) to start fresh workers with new
+code and settings while the old ones finish their requests.
+"""
+
+import multiprocessing
+import os
+
+
+bind = os.environ.get("WEB_BIND", "0.0.0.0:5000")
+
+# Each worker is a process with its own database connections and caches
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+
+# Threads let a worker keep serving while other requests wait on PostgreSQL
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+
+# Workers are forked before the app is imported so none share a connection
+preload_app = False
+
+timeout = 30
+graceful_timeout = 30
+
+# Recycle workers now and then so slow leaks can't build up
+max_requests = 1000
+max_requests_jitter = 100
+
+accesslog = "-"
+errorlog = "-"
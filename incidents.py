@@ -0,0 +1,49 @@
+"""One row per incident, so listings don't need DISTINCT over events"""
+
+from sqlalchemy import distinct, func
+from model import Event, Incident, db
+from funding import chunks, insert_rows
+
+
+def incident_rows(fema_ids=None):
+    """Summarize the events of each incident into one row"""
+
+    query = db.session.query(Event.fema_id,
+                             func.min(Event.declaration_id),
+                             func.min(Event.state_id),
+                             func.min(Event.name),
+                             func.min(Event.start_date),
+                             func.max(Event.end_date),
+                             func.min(Event.declared_on),
+                             func.max(Event.close_out_date),
+                             func.min(Event.disaster_type),
+                             func.count(distinct(Event.county))
+                             ).filter(Event.fema_id.isnot(None)
+                             ).group_by(Event.fema_id)
+
+    if fema_ids is not None:
+        query = query.filter(Event.fema_id.in_(fema_ids))
+
+    columns = ("fema_id", "declaration_id", "state_id", "name", "start_date",
+               "end_date", "declared_on", "close_out_date", "disaster_type",
+               "county_count")
+
+    return [dict(zip(columns, row)) for row in query]
+
+
+def refresh_incidents(fema_ids=None):
+    """Rebuild the incidents table, or only the given incidents
+
+    Nothing is committed, so a reseed can refresh incidents in the same
+    transaction that changed their events.
+    """
+
+    if fema_ids is None:
+        Incident.query.delete()
+        insert_rows(Incident, incident_rows())
+        return
+
+    for chunk in chunks(sorted(fema_ids)):
+        Incident.query.filter(Incident.fema_id.in_(chunk)
+                              ).delete(synchronize_session=False)
+        insert_rows(Incident, incident_rows(chunk))
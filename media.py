@@ -0,0 +1,108 @@
+"""Responsive, long-cached page images built by build_media.py
+
+Templates call picture() for an <img> with AVIF/WebP sources and a
+srcset, and poster() for a video poster. Both fall back to the original
+file when build_media.py hasn't been run, so development needs no build.
+"""
+
+from flask import request, url_for
+from markupsafe import Markup, escape
+
+import json
+import os
+
+
+BUILD_DIRECTORY = "build"
+
+MANIFEST = f"{BUILD_DIRECTORY}/manifest.json"
+
+# Built files have a content hash in their names, so they never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Formats offered as <source> elements, best first; JPEG is the <img>
+SOURCE_TYPES = (("avif", "image/avif"), ("webp", "image/webp"))
+
+_manifest = {}
+
+
+def load_manifest(app):
+    """Read the manifest written by build_media.py, if there is one"""
+
+    path = os.path.join(app.static_folder, MANIFEST)
+
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def srcset(variants):
+    """Render [[width, path], ...] as a srcset attribute value"""
+
+    return ", ".join(f"{url_for('static', filename=path)} {width}w"
+                     for width, path in variants)
+
+
+def picture(path, alt="", sizes="100vw", class_=None):
+    """Return a <picture> for the static image at path
+
+    The browser picks the smallest built file that fills sizes, in the
+    best format it supports.
+    """
+
+    class_attribute = Markup(f' class="{escape(class_)}"') if class_ else ""
+    entry = _manifest.get(path)
+
+    if entry is None:
+        return Markup('<img src="{}" alt="{}"{}>').format(
+            url_for('static', filename=path), alt, class_attribute)
+
+    variants = entry["variants"]
+    sources = [Markup('<source type="{}" srcset="{}" sizes="{}">').format(
+                   mime_type, srcset(variants[name]), sizes)
+               for name, mime_type in SOURCE_TYPES if name in variants]
+
+    fallback = variants["jpeg"]
+    image = Markup('<img src="{}" srcset="{}" sizes="{}" width="{}" '
+                   'height="{}" alt="{}"{}>').format(
+        url_for('static', filename=fallback[-1][1]), srcset(fallback), sizes,
+        entry["width"], entry["height"], alt, class_attribute)
+
+    return Markup("<picture>{}{}</picture>").format(Markup("").join(sources),
+                                                    image)
+
+
+def poster(path):
+    """Return the URL of the largest built JPEG of a video poster image"""
+
+    entry = _manifest.get(path)
+    if entry is None:
+        return url_for('static', filename=path)
+
+    return url_for('static', filename=entry["variants"]["jpeg"][-1][1])
+
+
+def cache_built_files(response):
+    """Let browsers keep built, content-hashed files for a year"""
+
+    filename = (request.view_args or {}).get("filename", "")
+
+    if (request.endpoint == "static" and response.status_code in (200, 304)
+            and filename.startswith(f"{BUILD_DIRECTORY}/")
+            and filename != MANIFEST):
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+
+    return response
+
+
+def init_app(app):
+    """Load the image manifest and add the template helpers to app"""
+
+    global _manifest
+
+    _manifest = load_manifest(app)
+
+    app.add_template_global(picture)
+    app.add_template_global(poster)
+    app.after_request(cache_built_files)
@@ -0,0 +1,295 @@
+"""Request latency, SQL and template metrics in the Prometheus text format
+
+Each gunicorn worker keeps its own numbers, so /metrics shows the worker
+that answered the scrape. Set SLOW_REQUEST_SECONDS (in app.config or the
+environment) to also log every slower request with the SQL it ran.
+"""
+
+from flask import (before_render_template, current_app, g, request,
+                   template_rendered)
+
+import os
+import threading
+import time
+
+import dbpool
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Longest SQL statement kept in a slow request log entry
+MAX_LOGGED_STATEMENT = 2000
+
+
+###############################################################################
+# Metric types
+
+
+def escape(value):
+    """Escape a label value for the text format"""
+
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def format_labels(names, values, extra=()):
+    """Render {name="value",...} for a sample, or nothing without labels"""
+
+    pairs = [f'{name}="{escape(value)}"'
+             for name, value in list(zip(names, values)) + list(extra)]
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    """A total for each set of label values that only goes up"""
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        """Return the series key of a dict of label values"""
+
+        return tuple(labels[name] for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the total for labels"""
+
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        """Yield the sample lines of every series"""
+
+        with self.lock:
+            series = sorted(self.series.items())
+
+        for key, total in series:
+            yield f"{self.name}{format_labels(self.labels, key)} {total}"
+
+    def render(self):
+        """Return the HELP, TYPE and sample lines"""
+
+        return [f"# HELP {self.name} {self.description}",
+                f"# TYPE {self.name} {self.kind}",
+                *self.samples()]
+
+
+class Histogram(Counter):
+    """Bucketed observations, their sum and count, per set of label values"""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(),
+                 buckets=DURATION_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        """Count value in every bucket it fits and add it to the sum"""
+
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.series.get(
+                key, ((0,) * len(self.buckets), 0.0, 0))
+            counts = tuple(bucket + (value <= bound)
+                           for bucket, bound in zip(counts, self.buckets))
+            self.series[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        """Yield the cumulative bucket, sum and count lines of every series"""
+
+        with self.lock:
+            series = sorted(self.series.items())
+
+        for key, (counts, total, count) in series:
+            for bound, bucket in zip(self.buckets, counts):
+                labels = format_labels(self.labels, key, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {bucket}"
+            labels = format_labels(self.labels, key, [("le", "+Inf")])
+            yield f"{self.name}_bucket{labels} {count}"
+
+            labels = format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+###############################################################################
+# The app's metrics
+
+
+REQUESTS = Counter("http_requests_total",
+                   "Requests handled, by route and status code.",
+                   ("endpoint", "method", "status"))
+
+LATENCY = Histogram("http_request_duration_seconds",
+                    "Time to build each response, by route.",
+                    ("endpoint",))
+
+SQL_QUERIES = Histogram("http_request_sql_queries",
+                        "SQL statements run per request, by route.",
+                        ("endpoint",), buckets=QUERY_BUCKETS)
+
+SQL_SECONDS = Histogram("http_request_sql_seconds",
+                        "Time spent in SQL per request, by route.",
+                        ("endpoint",))
+
+TEMPLATE_SECONDS = Histogram("template_render_seconds",
+                             "Time to render each template.",
+                             ("template",))
+
+SLOW_REQUESTS = Counter("http_slow_requests_total",
+                        "Requests slower than SLOW_REQUEST_SECONDS.",
+                        ("endpoint",))
+
+COMPRESSED_BYTES = Counter("http_compressed_bytes_total",
+                           "Response bytes before (in) and after (out) "
+                           "compression.",
+                           ("encoding", "stage"))
+
+COMPRESSION_SECONDS = Counter("http_compression_seconds_total",
+                              "Time spent compressing responses.",
+                              ("encoding",))
+
+METRICS = (REQUESTS, LATENCY, SQL_QUERIES, SQL_SECONDS, TEMPLATE_SECONDS,
+           SLOW_REQUESTS, COMPRESSED_BYTES, COMPRESSION_SECONDS)
+
+# dbpool.TimedQueuePool.stats() fields shown as gauges, and their help
+POOL_GAUGES = {"size": "Connections kept open in the pool.",
+               "checked_out": "Connections in use right now.",
+               "saturation": "Share of the pool and overflow in use.",
+               "checkouts": "Connections handed out so far.",
+               "timeouts": "Checkouts that gave up waiting.",
+               "wait_seconds_total": "Time spent waiting for connections.",
+               "wait_seconds_max": "Longest wait for a connection."}
+
+
+def pool_lines():
+    """Render the connection pool stats of every engine as gauges"""
+
+    pools = sorted(dbpool.pool_stats().items())
+    lines = []
+
+    for field, description in POOL_GAUGES.items():
+        name = f"db_pool_{field}"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for label, stats in pools:
+            lines.append(f"{name}{format_labels(('pool',), (label,))} "
+                         f"{stats[field]}")
+
+    return lines
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format"""
+
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(pool_lines())
+
+    return "\n".join(lines) + "\n"
+
+
+###############################################################################
+# Request hooks
+
+
+def slow_request_seconds(app):
+    """Return the slow request threshold, or None when the log is off"""
+
+    value = app.config.get("SLOW_REQUEST_SECONDS",
+                           os.environ.get("SLOW_REQUEST_SECONDS"))
+
+    return float(value) if value else None
+
+
+def start_request():
+    """Note when the request started, and capture SQL for the slow log"""
+
+    g.request_started = time.perf_counter()
+    g.template_seconds = 0.0
+
+    if slow_request_seconds(current_app) is not None:
+        g.sql_log = []
+
+
+def start_template(sender, template, context, **extra):
+    """Note when a template started rendering"""
+
+    g.template_started = time.perf_counter()
+
+
+def end_template(sender, template, context, **extra):
+    """Record how long the template took to render"""
+
+    started = g.pop("template_started", None)
+    if started is None:
+        return
+
+    elapsed = time.perf_counter() - started
+    g.template_seconds = g.get("template_seconds", 0.0) + elapsed
+    TEMPLATE_SECONDS.observe(elapsed, template=template.name or "string")
+
+
+def log_slow_request(endpoint, elapsed):
+    """Log a slow request with every SQL statement it ran"""
+
+    SLOW_REQUESTS.inc(endpoint=endpoint)
+
+    statements = "".join(
+        f"\n  {seconds * 1000:8.1f} ms  {statement[:MAX_LOGGED_STATEMENT]}"
+        for seconds, statement in g.get("sql_log") or [])
+
+    current_app.logger.warning(
+        "Slow request %s %s took %.0f ms (%.0f ms SQL in %d queries, "
+        "%.0f ms templates)%s",
+        request.method, request.full_path, elapsed * 1000,
+        g.get("sql_seconds", 0.0) * 1000, g.get("sql_queries", 0),
+        g.get("template_seconds", 0.0) * 1000, statements)
+
+
+def record_request(response):
+    """Record the latency, SQL and status of the finished request"""
+
+    started = g.get("request_started")
+    if started is None:
+        return response
+
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+
+    REQUESTS.inc(endpoint=endpoint, method=request.method,
+                 status=response.status_code)
+    LATENCY.observe(elapsed, endpoint=endpoint)
+    SQL_QUERIES.observe(g.get("sql_queries", 0), endpoint=endpoint)
+    SQL_SECONDS.observe(g.get("sql_seconds", 0.0), endpoint=endpoint)
+
+    threshold = slow_request_seconds(current_app)
+    if threshold is not None and elapsed > threshold:
+        log_slow_request(endpoint, elapsed)
+
+    return response
+
+
+def init_app(app):
+    """Record metrics for every request app handles
+
+    Call this before any other before_request hook is added, so the time
+    and queries of those hooks are counted too.
+    """
+
+    app.before_request(start_request)
+    app.after_request(record_request)
+    before_render_template.connect(start_template, app)
+    template_rendered.connect(end_template, app)
@@ -0,0 +1,115 @@
+"""Move grants.grant strings into the grant_types lookup table
+
+Run once against a database seeded before grant_types existed:
+
+    python3 migrate_grant_types.py
+
+The grants table size and the time to total one grant type are printed
+before and after, so the saving can be checked on the real data.
+"""
+
+from sqlalchemy import text
+from model import connect_to_db, create_indexes, db
+
+import time
+
+import funding
+import seed
+
+
+# PA is the most common grant type, so it is the one timed
+TIMED_GRANT_TYPE = 1
+
+TIMED_RUNS = 20
+
+
+def table_size(table):
+    """Return (table bytes, index bytes) of a table"""
+
+    return db.session.execute(text(
+        "SELECT pg_table_size(:table), pg_indexes_size(:table)"),
+        {"table": table}).first()
+
+
+def time_query(statement, params):
+    """Return the median milliseconds of running a statement"""
+
+    timings = []
+    for _ in range(TIMED_RUNS):
+        started = time.perf_counter()
+        db.session.execute(text(statement), params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    return sorted(timings)[len(timings) // 2]
+
+
+def report(label, total_ms):
+    """Print the grants table size and a grant type query time"""
+
+    table_bytes, index_bytes = table_size("grants")
+    print(f"{label}: grants table {table_bytes / 1024:.0f} kB, "
+          f"indexes {index_bytes / 1024:.0f} kB, "
+          f"total by type {total_ms:.2f} ms")
+
+
+def has_grant_column():
+    """Check whether grants still has its old string column"""
+
+    return db.session.execute(text(
+        "SELECT count(*) FROM information_schema.columns "
+        "WHERE table_name = 'grants' AND column_name = 'grant'")).scalar() > 0
+
+
+def migrate():
+    """Add grant_type_id to grants, fill it in and drop the strings"""
+
+    db.session.execute(text(
+        'ALTER TABLE grants ADD COLUMN IF NOT EXISTS grant_type_id SMALLINT '
+        'REFERENCES grant_types (id)'))
+    db.session.execute(text(
+        'UPDATE grants SET grant_type_id = grant_types.id FROM grant_types '
+        'WHERE grants."grant" = grant_types.name'))
+    db.session.execute(text(
+        'ALTER TABLE grants ALTER COLUMN grant_type_id SET NOT NULL'))
+    db.session.execute(text('ALTER TABLE grants DROP COLUMN "grant"'))
+
+    # The summary tables are derived data, so they are simply rebuilt
+    db.session.execute(text("DROP TABLE IF EXISTS funding_rollups"))
+    db.session.execute(text("DROP TABLE IF EXISTS incident_funding"))
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    with app.app_context():
+        if not has_grant_column():
+            print("grants.grant is already gone, nothing to migrate.")
+            raise SystemExit
+
+        db.create_all()
+        seed.load_grant_types()
+
+        name = seed.GRANT_TYPES[TIMED_GRANT_TYPE]
+        report("Before", time_query(
+            'SELECT count(*), sum(total) FROM grants WHERE "grant" = :name',
+            {"name": name}))
+
+        migrate()
+
+        # Rewrite the table so the dropped column's space is given back
+        connection = db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT")
+        connection.execute("VACUUM FULL ANALYZE grants")
+        connection.close()
+
+        db.create_all()
+        create_indexes()
+        funding.refresh_funding()
+        db.session.commit()
+
+        report("After", time_query(
+            "SELECT count(*), sum(total) FROM grants "
+            "WHERE grant_type_id = :grant_type_id",
+            {"grant_type_id": TIMED_GRANT_TYPE}))
@@ -1,9 +1,15 @@
 """Models and database functions for California Disaster project"""
 
-from flask_sqlalchemy import SQLAlchemy
+from dbpool import PooledSQLAlchemy, REPLICA
+from sqlalchemy import extract, inspect
+from sqlalchemy.schema import CreateIndex
 
+from datetime import datetime
 
-db = SQLAlchemy()
+import os
+
+
+db = PooledSQLAlchemy()
 
 ###############################################################################
 # Model definitions
@@ -40,7 +46,19 @@ class Event(db.Model):
 
     user_id = db.Column(db.ForeignKey('users.id'))
 
-    damaged_property = db.Column(db.Boolean, default=False)
+    damaged_property = db.Column(db.Boolean, default=False,
+                                 server_default=db.false())
+
+    # Indexes matched to the listing, search and detail routes in server.py
+    __table_args__ = (
+        db.Index('ix_events_fema_id_county', fema_id, county),
+        db.Index('ix_events_state_type_fema_id',
+                 state_id, disaster_type, fema_id),
+        db.Index('ix_events_type_fema_id', disaster_type, fema_id),
+        db.Index('ix_events_declaration_fema_id', declaration_id, fema_id),
+        db.Index('ix_events_declared_on_fema_id', declared_on, fema_id),
+        db.Index('ix_events_declared_month', extract('month', declared_on)),
+    )
 
     def __repr__(self):
         """Display info about the disaster event"""
@@ -66,17 +84,49 @@ class Grant(db.Model):
 
     total = db.Column(db.Float)
 
-    grant = db.Column(db.String)
+    grant_type_id = db.Column(db.SmallInteger,
+                              db.ForeignKey('grant_types.id'),
+                              nullable=False,
+                              index=True)
+
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False,
+                         index=True)
 
-    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
+    # When FEMA last updated the totals, from the last column of grant.txt
+    reported_on = db.Column(db.Date)
+
+    # Only a handful of types, so always join them in
+    grant_type = db.relationship('GrantType', lazy='joined')
 
     def __repr__(self):
         """Display information about funding that was granted"""
 
         return f"""<Grant Total ID: {self.id}
                    Total: {self.total}
-                   Grant Type: {self.grant}
+                   Grant Type ID: {self.grant_type_id}
                    Event ID: {self.event_id}>"""
+
+
+# Grant types summed for "all funding". PA already includes Emergency Work
+# and Permanent Work, IHP is HA plus ONA, and IA counts applications
+# rather than dollars, so adding any of those would count money twice
+TOP_LEVEL_GRANT_TYPES = (1, 4)
+
+
+class GrantType(db.Model):
+    """The kinds of funding FEMA reports, e.g. Public Assistance"""
+
+    __tablename__ = "grant_types"
+
+    id = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+
+    name = db.Column(db.String, unique=True, nullable=False)
+
+    def __repr__(self):
+        """Display the grant type"""
+
+        return f"""<Grant Type ID: {self.id}
+                   Name: {self.name}>"""
                    
 
 class User(db.Model):
@@ -125,19 +175,218 @@ class UserSearch(db.Model):
                    Event ID:{self.events_id}>"""
 
 
+class Incident(db.Model):
+    """One row per FEMA ID, summarizing its per-county events"""
+
+    __tablename__ = "incidents"
+
+    fema_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    declaration_id = db.Column(db.String)
+
+    state_id = db.Column(db.String)
+
+    name = db.Column(db.String)
+
+    start_date = db.Column(db.Date)
+
+    end_date = db.Column(db.Date)
+
+    declared_on = db.Column(db.Date)
+
+    close_out_date = db.Column(db.Date)
+
+    disaster_type = db.Column(db.String)
+
+    county_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Incidents are built from events by seed.py, so no foreign key is
+    # declared between them; the joins are on fema_id
+    events = db.relationship('Event',
+                             primaryjoin='Incident.fema_id '
+                                         '== foreign(Event.fema_id)',
+                             order_by='Event.county',
+                             viewonly=True)
+
+    grants = db.relationship('IncidentFunding',
+                             primaryjoin='Incident.fema_id '
+                                         '== foreign(IncidentFunding.fema_id)',
+                             order_by='IncidentFunding.grant_type_id',
+                             viewonly=True)
+
+    # Indexes matched to the search filters in server.filter_events()
+    __table_args__ = (
+        db.Index('ix_incidents_state_type', state_id, disaster_type),
+        db.Index('ix_incidents_type', disaster_type),
+        db.Index('ix_incidents_declared_on', declared_on),
+        db.Index('ix_incidents_declared_month',
+                 extract('month', declared_on)),
+    )
+
+    def __repr__(self):
+        """Display info about the incident"""
+
+        return f"""<Incident FEMA ID: {self.fema_id}
+                   Declaration ID: {self.declaration_id}
+                   State ID: {self.state_id}
+                   Name: {self.name}
+                   Counties: {self.county_count}
+                   Declared On: {self.declared_on}
+                   Disaster Type: {self.disaster_type}>"""
+
+
+class IncidentFunding(db.Model):
+    """Funding of each grant type for a whole incident, built by seed.py"""
+
+    __tablename__ = "incident_funding"
+
+    fema_id = db.Column(db.Integer, primary_key=True)
+
+    grant_type_id = db.Column(db.SmallInteger,
+                              db.ForeignKey('grant_types.id'),
+                              primary_key=True)
+
+    state_id = db.Column(db.String)
+
+    disaster_type = db.Column(db.String)
+
+    year = db.Column(db.Integer)
+
+    total = db.Column(db.Float, nullable=False)
+
+    grant_type = db.relationship('GrantType', lazy='joined')
+
+    def __repr__(self):
+        """Display the funding of an incident"""
+
+        return f"""<Incident Funding FEMA ID: {self.fema_id}
+                   Grant Type ID: {self.grant_type_id}
+                   Total: {self.total}>"""
+
+
+class FundingRollup(db.Model):
+    """Funding totals by state, disaster type, year or county"""
+
+    __tablename__ = "funding_rollups"
+
+    dimension = db.Column(db.String, primary_key=True)
+
+    key = db.Column(db.String, primary_key=True)
+
+    grant_type_id = db.Column(db.SmallInteger,
+                              db.ForeignKey('grant_types.id'),
+                              primary_key=True)
+
+    total = db.Column(db.Float, nullable=False)
+
+    incidents = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        """Display a funding total"""
+
+        return f"""<Funding Rollup {self.dimension}: {self.key}
+                   Grant Type ID: {self.grant_type_id}
+                   Total: {self.total}
+                   Incidents: {self.incidents}>"""
+
+
+class Centroid(db.Model):
+    """Where a state or county is placed on the map, loaded by seed.py"""
+
+    __tablename__ = "centroids"
+
+    state_id = db.Column(db.String, primary_key=True)
+
+    # geo.county_key() of the county name, or "" for the state itself
+    county = db.Column(db.String, primary_key=True, default="")
+
+    name = db.Column(db.String, nullable=False)
+
+    latitude = db.Column(db.Float, nullable=False)
+
+    longitude = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        """Display a centroid"""
+
+        return f"""<Centroid {self.state_id} {self.county}
+                   Name: {self.name}
+                   At: {self.latitude}, {self.longitude}>"""
+
+
+class SeedRun(db.Model):
+    """Each completed run of seed.py, used to tell when cached data is stale"""
+
+    __tablename__ = "seed_runs"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    finished_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    def __repr__(self):
+        """Display information about the seed run"""
+
+        return f"""<Seed Run ID: {self.id}
+                   Finished At: {self.finished_at}>"""
+
+
 ###############################################################################
 
-def connect_to_db(app, database='postgresql:///disasters'):
-    """Connect the database to Flask app."""
+def connect_to_db(app, database='postgresql:///disasters', replica=None,
+                  pool=None):
+    """Connect the database to Flask app.
+
+    replica is an optional read-only copy of the database for the routes
+    marked read_only, defaulting to $DATABASE_REPLICA_URL. pool overrides
+    the settings from dbpool.pool_profile().
+    """
 
     app.config['SQLALCHEMY_DATABASE_URI'] = database
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    replica = (replica or app.config.get('DATABASE_REPLICA_URL')
+               or os.environ.get('DATABASE_REPLICA_URL'))
+    if replica:
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA: replica}
+    if pool:
+        app.config['DB_POOL'] = pool
+
     db.app = app
     db.init_app(app)
 
 
+def create_indexes():
+    """Add any indexes missing from tables that create_all() already made"""
+
+    # create_all() skips tables that exist, so their new indexes are added
+    # here; IF NOT EXISTS also covers expression indexes that don't reflect
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            statement = str(CreateIndex(index).compile(db.engine))
+            db.engine.execute(statement.replace(
+                "CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1))
+
+
+def add_missing_columns():
+    """Add nullable columns missing from tables create_all() already made"""
+
+    inspector = inspect(db.engine)
+
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"]
+                    for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(db.engine.dialect)
+            db.engine.execute(f"ALTER TABLE {table.name} "
+                              f"ADD COLUMN {column.name} {column_type}")
+
+
 if __name__ == "__main__":
     from server import app
     connect_to_db(app)
     print("Connected to DB.")
-    db.create_all()
\ No newline at end of file
+    db.create_all()
+    add_missing_columns()
+    create_indexes()
\ No newline at end of file
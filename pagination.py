@@ -0,0 +1,80 @@
+"""Keyset pagination over FEMA IDs for the listing and search pages"""
+
+import base64
+import json
+
+
+def encode_cursor(direction, fema_id):
+    """Make an opaque page token for the rows after or before a FEMA ID"""
+
+    raw = json.dumps({direction: fema_id}).encode()
+
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Return (direction, fema_id) from a page token, or None if invalid"""
+
+    if not token:
+        return None
+
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+
+    # Anything but a single {direction: fema_id} pair is a forged token
+    if not isinstance(payload, dict) or len(payload) != 1:
+        return None
+
+    (direction, fema_id), = payload.items()
+
+    if (direction not in ("after", "before") or not isinstance(fema_id, int)
+            or isinstance(fema_id, bool)):
+        return None
+
+    return direction, fema_id
+
+
+def keyset_page(query, column, token, page_size):
+    """Return one page of query, ordered by a unique fema_id column
+
+    The page starts right after (or ends right before) the FEMA ID in the
+    token, so every page costs the same as the first one no matter how
+    deep it is. Returns (rows, next_token, previous_token), where a
+    token is None when there is no page in that direction.
+    """
+
+    cursor = decode_cursor(token)
+
+    if cursor and cursor[0] == "before":
+        query = query.filter(column < cursor[1]).order_by(column.desc())
+    else:
+        if cursor:
+            query = query.filter(column > cursor[1])
+        query = query.order_by(column)
+
+    # Fetch one extra row to find out if there is another page
+    events = query.limit(page_size + 1).all()
+    has_more = len(events) > page_size
+    events = events[:page_size]
+
+    if cursor and cursor[0] == "before":
+        events.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, cursor is not None
+
+    if not events:
+        return events, None, None
+
+    next_token = None
+    previous_token = None
+
+    if has_next:
+        next_token = encode_cursor("after", events[-1].fema_id)
+    if has_previous:
+        previous_token = encode_cursor("before", events[0].fema_id)
+
+    return events, next_token, previous_token
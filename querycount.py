@@ -0,0 +1,57 @@
+"""Per-request SQL query counting and timing, to spot slow or N+1 routes"""
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import time
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Add one to the query count of the request being handled"""
+
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        conn.info['query_started'] = time.perf_counter()
+
+
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    """Add the query's time to the request, keeping it if g.sql_log is set"""
+
+    started = conn.info.pop('query_started', None)
+    if started is None or not has_request_context():
+        return
+
+    elapsed = time.perf_counter() - started
+    g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+
+    if g.get('sql_log') is not None:
+        g.sql_log.append((elapsed, statement))
+
+
+def report_queries(response):
+    """Send the query count in a header and log routes that run too many"""
+
+    count = g.get('sql_queries', 0)
+
+    if current_app.config.get('SQL_QUERY_HEADER', current_app.debug):
+        response.headers['X-SQL-Queries'] = str(count)
+        response.headers['X-SQL-Time'] = (
+            f"{g.get('sql_seconds', 0.0) * 1000:.1f}ms")
+
+    if count > current_app.config.get('SQL_QUERY_WARNING', 20):
+        current_app.logger.warning("%s ran %d SQL queries",
+                                   request.path, count)
+
+    return response
+
+
+def init_app(app):
+    """Count and time the SQL queries run while handling each request"""
+
+    if not event.contains(Engine, 'before_cursor_execute', count_query):
+        event.listen(Engine, 'before_cursor_execute', count_query)
+    if not event.contains(Engine, 'after_cursor_execute', time_query):
+        event.listen(Engine, 'after_cursor_execute', time_query)
+
+    app.after_request(report_queries)
@@ -0,0 +1,208 @@
+"""Response cache for the pages anonymous visitors see"""
+
+from flask import Response, request, session
+from werkzeug.http import http_date
+
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+
+import hashlib
+import json
+import threading
+
+import stats
+
+
+###############################################################################
+# Backends
+
+
+class LRUBackend(object):
+    """Keep the most recently used pages in this process's memory"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached page for key, or None"""
+
+        with self.lock:
+            page = self.entries.get(key)
+            if page is not None:
+                self.entries.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        """Cache a page under key, dropping the least recently used one"""
+
+        with self.lock:
+            self.entries[key] = page
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached page"""
+
+        with self.lock:
+            self.entries.clear()
+
+
+class SharedBackend(object):
+    """Keep pages in a key-value store shared by every worker, like Redis
+
+    The client needs get(), set(key, value, ex=seconds) and incr(), as
+    redis.Redis has. Clearing bumps a generation number that is part of
+    every key, so old pages are never read again and simply expire.
+    """
+
+    def __init__(self, client, prefix="disasters:page:", timeout=3600):
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def _key(self, key):
+        """Prefix key with the store's current generation"""
+
+        generation = self.client.get(f"{self.prefix}generation") or 0
+        return f"{self.prefix}{int(generation)}:{key}"
+
+    def get(self, key):
+        """Return the cached page for key, or None"""
+
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            return None
+
+        page = json.loads(raw)
+        page["body"] = page["body"].encode("utf-8")
+        return page
+
+    def set(self, key, page):
+        """Cache a page under key until the timeout runs out"""
+
+        raw = json.dumps(dict(page, body=page["body"].decode("utf-8")))
+        self.client.set(self._key(key), raw, ex=self.timeout)
+
+    def clear(self):
+        """Stop serving every page cached so far"""
+
+        self.client.incr(f"{self.prefix}generation")
+
+
+class LocalClient(object):
+    """In-process stand-in for a Redis client, for development and tests"""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored under key, or None"""
+
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        """Store value under key; ex is accepted but not enforced"""
+
+        self.values[key] = value
+
+    def incr(self, key):
+        """Add one to the integer stored under key"""
+
+        with self.lock:
+            self.values[key] = int(self.values.get(key, 0)) + 1
+            return self.values[key]
+
+
+###############################################################################
+# Cached views
+
+
+_backend = LRUBackend()
+_seen_version = {}
+
+
+def init_app(app, backend=None):
+    """Choose the cache backend from the argument or app.config"""
+
+    global _backend
+
+    _backend = (backend
+                or app.config.get("RESPONSE_CACHE_BACKEND")
+                or LRUBackend(app.config.get("RESPONSE_CACHE_SIZE", 256)))
+
+
+def clear():
+    """Drop every cached page, e.g. after seed.py reloads the data"""
+
+    _backend.clear()
+
+
+def cache_key():
+    """Build a key from the route and its exact query args in order
+
+    Views read the raw values, so " CA" and "CA" must not share a page.
+    """
+
+    args = sorted(request.args.items(multi=True))
+
+    return json.dumps([request.endpoint, request.view_args, args],
+                      sort_keys=True, default=str)
+
+
+def is_cacheable():
+    """Only anonymous visitors with no pending flash messages share pages"""
+
+    return (request.method == "GET"
+            and "user_id" not in session
+            and "_flashes" not in session)
+
+
+def respond(page):
+    """Turn a cached page into a response that browsers can revalidate"""
+
+    response = Response(page["body"], mimetype=page["mimetype"])
+    response.set_etag(page["etag"])
+    response.headers["Last-Modified"] = page["last_modified"]
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Cookie")
+
+    return response.make_conditional(request)
+
+
+def cached_page(view):
+    """Serve view from the cache for anonymous visitors until the reseed"""
+
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+        if not is_cacheable():
+            return view(*args, **kwargs)
+
+        # Pages from before the latest seed run are stale
+        version = stats.data_version()
+        if _seen_version.get("version", version) != version:
+            clear()
+        _seen_version["version"] = version
+
+        key = cache_key()
+        page = _backend.get(key)
+
+        if page is None:
+            response = view(*args, **kwargs)
+            if not isinstance(response, str) or not is_cacheable():
+                return response
+
+            body = response.encode("utf-8")
+            page = {"body": body,
+                    "mimetype": "text/html",
+                    "etag": hashlib.md5(body).hexdigest(),
+                    "last_modified": http_date(datetime.utcnow())}
+            _backend.set(key, page)
+
+        return respond(page)
+
+    return cached_view
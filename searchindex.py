@@ -0,0 +1,164 @@
+"""In-memory prefix index for search-as-you-type over incidents
+
+Every word of an incident's name, disaster type and county names points
+at the incidents it appears in. A query matches the incidents that have
+a word starting with each of its words, so "los ang fi" finds the Los
+Angeles fires. The index is rebuilt after each reseed, like stats.py.
+"""
+
+from model import Event, Incident, db
+
+from bisect import bisect_left
+
+import heapq
+import re
+import threading
+
+import stats
+
+
+# Most suggestions returned for one query
+MAX_RESULTS = 10
+
+# Shorter queries match most of the table, so they return nothing
+MIN_QUERY_LENGTH = 2
+
+WORD = re.compile(r"[a-z0-9]+")
+
+_lock = threading.Lock()
+_index = {}
+
+
+def words(text):
+    """Split text into lowercase words"""
+
+    return WORD.findall((text or "").lower())
+
+
+class PrefixIndex:
+    """Sorted words, each with the FEMA IDs of the incidents using it"""
+
+    def __init__(self, incidents, counties):
+        incident_words = {fema_id: set(words(incident["name"])
+                                       + words(incident["disaster_type"]))
+                          for fema_id, incident in incidents.items()}
+        for fema_id, county in counties:
+            if fema_id in incident_words:
+                incident_words[fema_id].update(words(county))
+
+        postings = {}
+        for fema_id, found in incident_words.items():
+            for word in found:
+                postings.setdefault(word, []).append(fema_id)
+
+        self.words = sorted(postings)
+        # Newest incidents first, so a lookup can stop after the first few
+        self.postings = [sorted(postings[word], reverse=True)
+                         for word in self.words]
+        self.incident_words = {fema_id: tuple(found)
+                               for fema_id, found in incident_words.items()}
+        self.incidents = incidents
+
+    def word_range(self, prefix):
+        """Return the (start, end) slice of the words starting with prefix"""
+
+        start = bisect_left(self.words, prefix)
+        # "{" sorts right after "z", so this is the first non-matching word
+        end = bisect_left(self.words, prefix + "{", start)
+
+        return start, end
+
+    def newest_matching(self, start, end):
+        """Yield the FEMA IDs using any of words[start:end], newest first"""
+
+        previous = None
+        for fema_id in heapq.merge(*self.postings[start:end], reverse=True):
+            if fema_id != previous:
+                yield fema_id
+            previous = fema_id
+
+    def search(self, query, limit=MAX_RESULTS):
+        """Return up to limit incidents matching every word of query
+
+        The most recent incidents (highest FEMA IDs) come first. Only the
+        term with the fewest postings is walked, newest first, and each
+        incident it yields is checked against the other terms, so a short
+        prefix matching most incidents still stops after limit results.
+        """
+
+        terms = words(query)
+        if sum(len(term) for term in terms) < MIN_QUERY_LENGTH:
+            return []
+
+        ranges = [self.word_range(term) for term in terms]
+        sizes = [sum(map(len, self.postings[start:end]))
+                 for start, end in ranges]
+        walked = sizes.index(min(sizes))
+        others = terms[:walked] + terms[walked + 1:]
+
+        results = []
+        for fema_id in self.newest_matching(*ranges[walked]):
+            found = self.incident_words[fema_id]
+            if all(any(word.startswith(term) for word in found)
+                   for term in others):
+                results.append(self.incidents[fema_id])
+                if len(results) == limit:
+                    break
+
+        return results
+
+
+def invalidate():
+    """Drop the index so the next lookup rebuilds it"""
+
+    with _lock:
+        _index.clear()
+
+
+def build_index():
+    """Read every incident and county from the database into an index"""
+
+    incidents = {}
+    for (fema_id, name, state_id, disaster_type,
+         declared_on) in db.session.query(Incident.fema_id,
+                                          Incident.name,
+                                          Incident.state_id,
+                                          Incident.disaster_type,
+                                          Incident.declared_on):
+        incidents[fema_id] = {
+            "fema_id": fema_id,
+            "name": name,
+            "state_id": state_id,
+            "disaster_type": disaster_type,
+            "declared_on": declared_on.isoformat() if declared_on else None}
+
+    counties = db.session.query(Event.fema_id, Event.county
+                                ).filter(Event.fema_id.in_(
+                                    db.session.query(Incident.fema_id))
+                                ).distinct()
+
+    return PrefixIndex(incidents, counties)
+
+
+def get_index():
+    """Return the prefix index, rebuilding it after a reseed"""
+
+    version = stats.data_version()
+
+    with _lock:
+        if _index.get("version") == version and "index" in _index:
+            return _index["index"]
+
+    index = build_index()
+
+    with _lock:
+        _index["version"] = version
+        _index["index"] = index
+
+    return index
+
+
+def search(query, limit=MAX_RESULTS):
+    """Return up to limit incidents matching query as dicts"""
+
+    return get_index().search(query, limit)
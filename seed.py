@@ -1,86 +1,403 @@
 """File to seed the tables created in model.py from the files in seed_data/"""
 
-from sqlalchemy import func
-from model import Event, Grant
-from model import connect_to_db, db
+from sqlalchemy import bindparam, func, select
+from model import Centroid, Event, Grant, GrantType, SeedRun
+from model import add_missing_columns, connect_to_db, create_indexes, db
 
-from datetime import datetime
+from fetch_centroids import fetch_counties
 from server import app
+from sourcefiles import GRANT_TYPES, ParseReport, read_records
 
+import argparse
+import csv
+import io
+import os
+import time
 
-def load_events():
-    """Load events from event.txt file into the database"""
+import facets
+import funding
+import geo
+import incidents
+import responsecache
+import searchindex
+import stats
+import timeseries
+
+
+EVENT_COLUMNS = ("declaration_id", "fema_id", "state_id", "name", "county",
+                 "start_date", "end_date", "declared_on", "close_out_date",
+                 "disaster_type", "damaged_property")
+
+GRANT_COLUMNS = ("total", "grant_type_id", "event_id", "reported_on")
+
+EVENT_KEY = ("declaration_id", "fema_id", "county")
+
+GRANT_KEY = ("event_id", "grant_type_id")
+
+BATCH_SIZE = 5000
+
+
+def batches(rows, size=BATCH_SIZE):
+    """Group an iterable of rows into lists of at most size rows"""
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def insert_batch(table, columns, rows):
+    """Write a batch of row dicts, using COPY when the database supports it"""
+
+    connection = db.session.connection()
+
+    if connection.dialect.name != "postgresql":
+        connection.execute(table.insert(), rows)
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) "
+                       "FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def load_events(path="seed_data/event.txt", batch_size=BATCH_SIZE,
+                processes=None):
+    """Stream events from event.txt into the database in batches"""
 
     print("Events")
 
     # Delete rows in the table to prevent duplicates if run twice
     Event.query.delete()
 
-    # Read event.txt, organize data, and insert data
-    for row in open("seed_data/event.txt"):
-        row = row.rstrip().replace("\t", "").split("|")
-        # Add list comprehension here in a later version of this file
-        for index, value in enumerate(row):
-            if value == "":
-                row[index] = None
+    started = time.perf_counter()
+    loaded = 0
+    report = ParseReport()
 
-        # row = [None for value in row if value == ""]
+    # The file is parsed on every core while the batches are written
+    for batch in batches(read_records(path, "event", processes,
+                                      report=report),
+                         batch_size):
+        insert_batch(Event.__table__, EVENT_COLUMNS, batch)
+        loaded += len(batch)
+        print(f"  {loaded} events loaded")
 
-        declaration_id, fema_id, state_id, state, name, county, start_date, end_date, declared_on, close_out_date,  disaster_type = row
+    # Commit changes
+    db.session.commit()
 
-        name = name.lower().title()
-        name = f"{state_id} {name}"
+    elapsed = time.perf_counter() - started
+    rate = loaded / elapsed if elapsed else 0
+    print(report)
+    print(f"Loaded {loaded} events in {elapsed:.1f}s ({rate:.0f} rows/s)")
 
-        events = Event(declaration_id=declaration_id,
-                       fema_id=fema_id,
-                       state_id=state_id,
-                       name=name,
-                       county=county,
-                       start_date=start_date,
-                       end_date=end_date,
-                       declared_on=declared_on,
-                       close_out_date=close_out_date,
-                       disaster_type=disaster_type)
 
-        # Add event to the session to be stored
-        db.session.add(events)
+def event_ids_by_fema_id():
+    """Map each FEMA ID to the ids of its events with a single query"""
+
+    event_ids = {}
+    for fema_id, event_id in db.session.query(Event.fema_id, Event.id):
+        event_ids.setdefault(fema_id, []).append(event_id)
+
+    return event_ids
+
+
+def grant_rows(record, event_ids):
+    """Turn one parsed grant.txt line into Grant row dicts for each event"""
+
+    return [{"total": total,
+             "grant_type_id": grant_type_id,
+             "event_id": event_id,
+             "reported_on": record["reported_on"]}
+            for event_id in event_ids.get(record["fema_id"], [])
+            for grant_type_id, total in record["totals"].items()]
+
+
+def load_grant_types():
+    """Add any grant types missing from the grant_types table"""
+
+    existing = {grant_type.id for grant_type in GrantType.query}
+
+    for grant_type_id, name in GRANT_TYPES.items():
+        if grant_type_id not in existing:
+            db.session.add(GrantType(id=grant_type_id, name=name))
 
-    # Commit changes
     db.session.commit()
 
 
-def load_grants():
+def load_centroids(states_path="seed_data/state_centroids.txt",
+                   counties_path="seed_data/county_centroids.txt"):
+    """Replace the map centroids of states and counties
+
+    State centroids ship in seed_data. County centroids come from the
+    Census Bureau's counties gazetteer file, which is tab separated with
+    a header row; fetch_centroids.py downloads it to counties_path when
+    it is missing.
+    """
+
+    Centroid.query.delete()
+
+    with open(states_path) as state_file:
+        for line in state_file:
+            state_id, name, latitude, longitude = line.rstrip().replace(
+                "\t", "").split("|")[:4]
+            db.session.add(Centroid(state_id=state_id,
+                                    county="",
+                                    name=name,
+                                    latitude=float(latitude),
+                                    longitude=float(longitude)))
+
+    if not os.path.exists(counties_path):
+        try:
+            fetch_counties(counties_path)
+        except OSError as error:
+            print(f"Could not download {counties_path} ({error})")
+
+    counties = set()
+    if os.path.exists(counties_path):
+        with open(counties_path, encoding="utf-8") as county_file:
+            reader = csv.DictReader(county_file, delimiter="\t")
+            for row in reader:
+                row = {column.strip(): value for column, value in row.items()}
+                county = (row["USPS"], geo.county_key(row["NAME"]))
+                if county in counties:
+                    continue
+                counties.add(county)
+                db.session.add(Centroid(state_id=county[0],
+                                        county=county[1],
+                                        name=row["NAME"],
+                                        latitude=float(row["INTPTLAT"]),
+                                        longitude=float(row["INTPTLONG"])))
+    else:
+        print(f"No {counties_path}, so counties won't be placed on the map")
+
+    db.session.commit()
+
+
+def load_grants(path="seed_data/grant.txt", batch_size=BATCH_SIZE,
+                processes=None):
     """Load grants from the grant.txt file into the database"""
 
     print("Grants")
 
     Grant.query.delete()
 
-    for row in open("seed_data/grant.txt"):
-        row = row.rstrip().replace("\t", "").split("|")
-        print(row[0])
-        events = Event.query.filter_by(fema_id=row[0]).all()
-        for event in events:
-            type_names = {0: "FEMA ID",
-                          1: "Total Public Assistance Grants (PA)",
-                          2: "Emergency Work(Categories A-B)",
-                          3: "Permanent Work (Categories C-G)",
-                          4: "Total Individual & Households Program (IHP)",
-                          5: "Total Individual Assistance (IA) Applications",
-                          6: "Total Housing Assistance (HA)",
-                          7: "Total Other Needs Assistance (ONA)"}
-
-            for index, value in enumerate(row):
-                if index > 0 and index < 8 and value != "":
-                    event.grants.append(Grant(total=value, grant=type_names[index]))
+    started = time.perf_counter()
+    loaded = 0
+    report = ParseReport()
+
+    event_ids = event_ids_by_fema_id()
+
+    rows = (grant
+            for record in read_records(path, "grant", processes,
+                                       report=report)
+            for grant in grant_rows(record, event_ids))
+
+    for batch in batches(rows, batch_size):
+        insert_batch(Grant.__table__, GRANT_COLUMNS, batch)
+        loaded += len(batch)
 
     db.session.commit()
 
+    elapsed = time.perf_counter() - started
+    rate = loaded / elapsed if elapsed else 0
+    print(report)
+    print(f"Loaded {loaded} grants in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+
+def update_batch(table, rows):
+    """Update a batch of row dicts by the id stored under their _id key"""
+
+    if rows:
+        db.session.connection().execute(
+            table.update().where(table.c.id == bindparam("_id")), rows)
+
+
+def row_digest(values):
+    """Hash a row's column values so it can be compared without keeping it"""
+
+    return hash(tuple(values))
+
+
+def sync_rows(table, columns, key, rows, batch_size=BATCH_SIZE, changed=None,
+              changed_column="fema_id"):
+    """Insert new rows and update changed ones, matching on the key columns
+
+    Rows already in the table but missing from the input are left alone so
+    saved searches keep pointing at them. Returns inserted, updated and
+    unchanged counts, and adds the changed_column value of each written
+    row to the changed set if given. Only each stored row's key, id and
+    digest are held in memory. Nothing is committed, so the caller
+    decides where the transaction ends.
+    """
+
+    key_positions = [columns.index(column) for column in key]
+
+    existing = {}
+    selected = [table.c.id] + [table.c[column] for column in columns]
+    stored = db.session.connection().execution_options(
+        stream_results=True).execute(select(selected))
+    for record in stored:
+        values = record[1:]
+        existing[tuple(values[position] for position in key_positions)] = (
+            record[0], row_digest(values))
+
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    inserts = []
+    updates = []
+
+    for row in rows:
+        row_key = tuple(row[column] for column in key)
+        digest = row_digest(row[column] for column in columns)
+        found = existing.get(row_key)
+
+        if found is None:
+            inserts.append(row)
+            existing[row_key] = (None, digest)
+            counts["inserted"] += 1
+            if changed is not None:
+                changed.add(row[changed_column])
+        elif found[1] == digest:
+            counts["unchanged"] += 1
+        elif found[0] is None:
+            # Repeated key within the input file, keep the first line
+            counts["unchanged"] += 1
+        else:
+            updates.append(dict(row, _id=found[0]))
+            existing[row_key] = (found[0], digest)
+            counts["updated"] += 1
+            if changed is not None:
+                changed.add(row[changed_column])
+
+        if len(inserts) == batch_size:
+            insert_batch(table, columns, inserts)
+            inserts = []
+        if len(updates) == batch_size:
+            update_batch(table, updates)
+            updates = []
+
+    if inserts:
+        insert_batch(table, columns, inserts)
+    update_batch(table, updates)
+
+    return counts
+
+
+def sync_events(path="seed_data/event.txt", batch_size=BATCH_SIZE,
+                changed=None, processes=None):
+    """Upsert events from event.txt without emptying the table first"""
+
+    report = ParseReport()
+    counts = sync_rows(Event.__table__, EVENT_COLUMNS, EVENT_KEY,
+                       read_records(path, "event", processes, report=report),
+                       batch_size, changed)
+    print(report)
+
+    return counts
+
+
+def sync_grants(path="seed_data/grant.txt", batch_size=BATCH_SIZE,
+                changed=None, processes=None):
+    """Upsert grants from grant.txt without emptying the table first"""
+
+    event_ids = event_ids_by_fema_id()
+    report = ParseReport()
+
+    rows = (grant
+            for record in read_records(path, "grant", processes,
+                                       report=report)
+            for grant in grant_rows(record, event_ids))
+
+    counts = sync_rows(Grant.__table__, GRANT_COLUMNS, GRANT_KEY, rows,
+                       batch_size, changed, changed_column="event_id")
+    print(report)
+
+    return counts
+
+
+def sync_all(processes=None):
+    """Sync events and grants in one transaction and report what changed"""
+
+    started = time.perf_counter()
+    # FEMA IDs of changed events, and ids of events with changed grants
+    changed_events = set()
+    changed_grants = set()
+
+    try:
+        for name, sync, changed in (("Events", sync_events, changed_events),
+                                    ("Grants", sync_grants, changed_grants)):
+            counts = sync(changed=changed, processes=processes)
+            print(f"{name}: {counts['inserted']} inserted, "
+                  f"{counts['updated']} updated, "
+                  f"{counts['unchanged']} unchanged")
+
+        # Only the incidents whose events or grants changed are re-totalled
+        fema_ids = set(changed_events)
+        if changed_grants:
+            event_ids = event_ids_by_fema_id()
+            fema_id_of = {event_id: fema_id
+                          for fema_id, ids in event_ids.items()
+                          for event_id in ids}
+            fema_ids.update(fema_id_of[event_id]
+                            for event_id in changed_grants)
+        incidents.refresh_incidents(changed_events)
+        funding.refresh_funding(fema_ids)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    print(f"Synced in {time.perf_counter() - started:.1f}s")
+
+
+def record_seed_run():
+    """Mark the seed as finished so cached counts and pages are rebuilt"""
+
+    db.session.add(SeedRun())
+    db.session.commit()
+
+    stats.invalidate()
+    searchindex.invalidate()
+    geo.invalidate()
+    facets.invalidate()
+    timeseries.invalidate()
+    responsecache.clear()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reload", action="store_true",
+                        help="empty the tables and load them from scratch")
+    parser.add_argument("--processes", type=int,
+                        help="processes parsing the files (default: one "
+                             "per core)")
+    args = parser.parse_args()
+
     from server import app
     connect_to_db(app)
     print("Connected to DB.")
     db.create_all()
-    load_events()
-    load_grants()
+    add_missing_columns()
+    create_indexes()
+    load_grant_types()
+    load_centroids()
+
+    if args.reload:
+        load_events(processes=args.processes)
+        load_grants(processes=args.processes)
+        incidents.refresh_incidents()
+        funding.refresh_funding()
+        db.session.commit()
+    else:
+        sync_all(args.processes)
+    record_seed_run()
@@ -1,19 +1,35 @@
 from jinja2 import StrictUndefined
 
 from flask import Flask, render_template, redirect, request, flash, session
-from flask import jsonify
+from flask import g, jsonify, Response, stream_with_context
 # from flask_debugtoolbar import DebugToolbarExtension
 
-from model import Event, Grant, User, UserSearch
+from model import Event, Grant, GrantType, Incident, User, UserSearch
 from model import connect_to_db, db
 
+import compress
+import dbpool
+import export
+import facets
+import funding
+import geo
+import media
+import metrics
+import querycount
+import responsecache
+import searchindex
+import stats
+import timeseries
+from pagination import keyset_page
+
 from bs4 import BeautifulSoup
 from urllib.request import Request, urlopen
+from werkzeug.urls import url_encode
 
 from sqlalchemy import distinct, extract
+from sqlalchemy.orm import joinedload, selectinload
 
 import os
-import math
 
 from datetime import datetime
 # import pdb; pdb.set_trace()
@@ -24,25 +40,124 @@ google_api_key = os.environ.get("GOOGLE_API_KEY")
 
 app.jinja_env.undefined = StrictUndefined
 
+compress.init_app(app)
+metrics.init_app(app)
+querycount.init_app(app)
+media.init_app(app)
+responsecache.init_app(app)
+
+# Most saved searches kept in the session cookie by load_user()
+MAX_SESSION_SEARCHES = 40
+
+# Default and largest page sizes of the JSON API
+API_PAGE_SIZE = 50
+MAX_API_PAGE_SIZE = 500
+
+# Seconds browsers may reuse the map regions before revalidating them
+GEO_MAX_AGE = 300
+
 ###############################################################################
 
 
-@app.route('/')
-def index():
-    """Homepage"""
+def filter_events(query, state_id='all', disaster_type='all',
+                  declaration_id='all', year=None, month=None, model=Event):
+    """Apply the search form filters to an Event or Incident query"""
+
+    if state_id != 'all':
+        query = query.filter_by(state_id=state_id)
+    if disaster_type != 'all':
+        query = query.filter_by(disaster_type=disaster_type)
+    if declaration_id != 'all':
+        query = query.filter_by(declaration_id=declaration_id)
+    if year:
+        query = query.filter(model.declared_on >= f'{year}-1-1' ,
+                             model.declared_on <= f'{year}-12-31')
+    if month:
+        # Same expression as the ix_incidents_declared_month and
+        # ix_events_declared_month indexes
+        query = query.filter(extract('month',
+                                     model.declared_on) == int(f'{month}'))
+
+    return query
+
+
+def search_filters():
+    """Read the search form filters from the query string of an API call
+
+    Unlike the search form, the API treats a missing filter as "all".
+    """
+
+    return {'state_id': request.args.get('state') or 'all',
+            'disaster_type': request.args.get('disaster-type') or 'all',
+            'declaration_id': request.args.get('declaration-id') or 'all',
+            'year': request.args.get('year'),
+            'month': request.args.get('month')}
+
+
+def page_url(cursor):
+    """Link to the current route and query args with another page cursor
+
+    The args are only encoded into the query string: passed to url_for()
+    as keywords, names like _scheme and _external would build the link.
+    """
+
+    if cursor is None:
+        return None
+
+    args = request.args.copy()
+    args.pop('page', None)
+    args['cursor'] = cursor
+
+    return f'{request.path}?{url_encode(args)}'
+
+
+@app.before_request
+def load_user():
+    """Load the logged in user and their saved searches once per request
+
+    The user's name and saved search summaries are kept in the session,
+    so most requests need no query at all. They are fetched together in
+    one query when the session has no copy, which happens after login and
+    after /save/event changes them.
+    """
+
+    g.user = None
+    g.user_saved_searches = None
 
     user_id = session.get('user_id')
-    user = None
-    user_saved_searches = None
+    if user_id is None:
+        return
+
+    cached = session.get('saved_searches')
+    if cached is None or cached['user']['id'] != user_id:
+        user = User.query.options(joinedload(User.searches)
+                                  ).filter_by(id=user_id).one_or_none()
+        if user is None:
+            session.pop('user_id')
+            session.pop('saved_searches', None)
+            return
 
-    if user_id is not None:
-      user = User.query.filter_by(id=user_id).one()
+        cached = {'user': {'id': user.id, 'username': user.username},
+                  'searches': [{'fema_id': event.fema_id,
+                                'name': event.name,
+                                'declaration_id': event.declaration_id}
+                               for event in user.searches]}
 
-      user_saved_searches = user.searches
+        # Long lists would overflow the session cookie, so load them each time
+        if len(cached['searches']) <= MAX_SESSION_SEARCHES:
+            session['saved_searches'] = cached
+
+    g.user = cached['user']
+    g.user_saved_searches = cached['searches']
+
+
+@app.route('/')
+def index():
+    """Homepage"""
 
     return render_template('homepage.html',
-                           user=user,
-                           user_saved_searches=user_saved_searches)
+                           user=g.user,
+                           user_saved_searches=g.user_saved_searches)
 
 
 @app.route('/users')  # Need to remove eventually
@@ -66,9 +181,7 @@ def show_user_page(user_id):
         return redirect('/login')
 
     user_saved_searches = user.searches
-    
-    print(user_saved_searches)
-    
+
     return render_template('user-info.html',
                            user=user,
                            user_saved_searches=user_saved_searches)
@@ -134,6 +247,7 @@ def process_login():
         return redirect('/login')
 
     session['user_id'] = user.id
+    session.pop('saved_searches', None)
 
     flash("Logged In")
 
@@ -145,116 +259,101 @@ def process_logout():
     """User logout and provide message upon success"""
 
     session.pop('user_id')
+    session.pop('saved_searches', None)
     flash('Logout Successful')
 
     return redirect('/')
 
 
 @app.route('/events')
+@dbpool.read_only
+@compress.conditional
+@responsecache.cached_page
 def events_list():
     """Show events list ordered by date"""
 
-    fema_id = request.args.get('fema-id')
+    fema_id = request.args.get('fema-id', '').strip()
+    if fema_id and not fema_id.isdigit():
+        # Typed a name instead of picking a suggestion: go to the best match
+        matches = searchindex.search(fema_id, limit=1)
+        if not matches:
+            flash('No matching disaster was found.')
+            return redirect('/events')
+        fema_id = str(matches[0]['fema_id'])
     if fema_id:
         return redirect(f'/events/{fema_id}')
     
-    disasters = set()
-    for row in open('seed_data/event.txt'):
-        row = row.rstrip().replace('\t', '').split('|')
-        incident = row[1]
-        disasters.add(incident)    
-    disaster = len(disasters)
+    disaster = stats.total_incidents()
     
     page_size = 50
-    pages = math.ceil(disaster / page_size)
-    page = request.args.get('page')  # returns args['page'] if exists, default to None
-    if page is None:
-        page = 0
+    cursor = request.args.get('cursor')
 
-    events = Event.query.order_by('fema_id'
-                                  ).limit(page_size
-                                  ).offset(int(page)*page_size
-                                  ).distinct('fema_id'
-                                  ).all()
+    # Grants for the whole page come from one batched SELECT ... IN
+    events, next_cursor, previous_cursor = keyset_page(
+        Incident.query.options(selectinload(Incident.grants)),
+        Incident.fema_id, cursor, page_size)
+    next_url = page_url(next_cursor)
+    previous_url = page_url(previous_cursor)
 
-    user_id = session.get('user_id')
-    if user_id is not None:
-        user = User.query.get(user_id)
-        user_saved_searches = user.searches
-        return render_template('event-list.html',
-                               events=events,
-                               disaster=disaster,
-                               pages=pages,
-                               user=user,
-                               user_saved_searches=user_saved_searches)
-    else:
-        return render_template('event-list.html',
-                               events=events,
-                               disaster=disaster,
-                               pages=pages)
+    return render_template('event-list.html',
+                           events=events,
+                           disaster=disaster,
+                           next_url=next_url,
+                           previous_url=previous_url,
+                           user=g.user,
+                           user_saved_searches=g.user_saved_searches)
 
 
 @app.route('/events/<fema_id>')
+@dbpool.read_only
+@compress.conditional
+@responsecache.cached_page
 def show_user_events_info(fema_id):
     """Display event information"""
     
-    event = Event.query.filter_by(fema_id=fema_id).first()
-    print(event)
-    counties = Event.query.filter_by(fema_id=fema_id
-                                     ).order_by(Event.county).all()
-    counties_affected = Event.query.filter_by(fema_id=fema_id
-                                     ).order_by(Event.county).count()
+    # One query for every county of the incident along with its grants
+    counties = Event.query.options(joinedload(Event.grants)
+                                   ).filter_by(fema_id=fema_id
+                                   ).order_by(Event.county).all()
+    event = counties[0] if counties else None
+    counties_affected = len(counties)
 
     if not event:
-        print("Oh no!")
         flash('This event does not exist or this datebase is incomplete.')
         return redirect('/')
 
-    user_id = session.get('user_id')
-    user = None
-    user_saved_searches = None
-    
-    if user_id is not None:
-        user = User.query.filter_by(id=user_id).one()
-
-        user_saved_searches = user.searches
-
-        return render_template('event-info.html',
-                               counties=counties,
-                               counties_affected=counties_affected,
-                               event=event,
-                               fema_id=fema_id,
-                               user=user,
-                               user_saved_searches=user_saved_searches)
-    else:
-        return render_template('event-info.html',
-                               counties=counties,
-                               counties_affected=counties_affected,
-                               event=event,
-                               fema_id=fema_id)
+    return render_template('event-info.html',
+                           counties=counties,
+                           counties_affected=counties_affected,
+                           event=event,
+                           fema_id=fema_id,
+                           user=g.user,
+                           user_saved_searches=g.user_saved_searches)
 
 @app.route('/save/event/<fema_id>', methods=['POST'])
 def save_event_info(fema_id):
     """Save an event"""
 
     users_id = session.get('user_id')
-    
-    print(users_id)
+
     event = Event.query.filter_by(fema_id=fema_id).first()
 
     user_search = UserSearch.query.filter_by(users_id=users_id,
                                              events_id=event.id
                                              ).first()
-    print(user_search)
+
     if user_search:
         flash('You have already saved this event.')
     else:
         user = User.query.get(users_id)
         user.searches.append(event)
 
-    db.session.add(user)
+        db.session.add(user)
 
-    db.session.commit()
+        db.session.commit()
+
+        # The saved searches changed, so reload them on the next request
+        session.pop('saved_searches', None)
     
     event_info = {
         "event_name": event.name,
@@ -264,32 +363,24 @@ def save_event_info(fema_id):
 
 
 @app.route('/search')
+@dbpool.read_only
 def show_search_options():
     """Show user the filter options available to look up an event"""
     
-    disasters = set()
-    for row in open('seed_data/event.txt'):
-        row = row.rstrip().replace('\t', '').split('|')
-        incident = row[1]
-        disasters.add(incident)    
-    disaster = len(disasters)
-
-    user_id = session.get('user_id')
-    user = None
-    user_saved_searches = None
-
-    if user_id is not None:
-        user = User.query.filter_by(id=user_id).one()
-
-        user_saved_searches = user.searches
+    disaster = stats.total_incidents()
+    facet_counts = facets.counts()['facets']
 
     return render_template('user-search.html',
                            disaster=disaster,
-                           user=user,
-                           user_saved_searches=user_saved_searches)
+                           facet_counts=facet_counts,
+                           user=g.user,
+                           user_saved_searches=g.user_saved_searches)
 
 
 @app.route('/search/results')
+@dbpool.read_only
+@compress.conditional
+@responsecache.cached_page
 def show_search_results():
     """Show user query filtered by options selected"""
 
@@ -299,48 +390,30 @@ def show_search_results():
     month = request.args.get('month')
     year = request.args.get('year')
     
-    user_choice = Event.query.distinct('fema_id')
-
-    if state_id != 'all':
-        user_choice = user_choice.filter_by(state_id=state_id)
-    if disaster_type != 'all':
-        user_choice = user_choice.filter_by(disaster_type=disaster_type)
-    if declaration_id != 'all':
-        user_choice = user_choice.filter_by(declaration_id=declaration_id)
-    if year:
-        user_choice = user_choice.filter(Event.declared_on >= f'{year}-1-1' ,
-                                         Event.declared_on <= f'{year}-12-31')
-    if month:
-        user_choice = user_choice.filter(extract('month',
-                                                 Event.declared_on
-                                                 ) == int(f'{month}'))
+    user_choice = Incident.query.options(selectinload(Incident.grants))
+    user_choice = filter_events(user_choice,
+                                state_id=state_id,
+                                disaster_type=disaster_type,
+                                declaration_id=declaration_id,
+                                year=year,
+                                month=month,
+                                model=Incident)
     
-    num_choices = user_choice.count()      
+    filters = (state_id, disaster_type, declaration_id, year, month)
+    num_choices = stats.cached_count(('search',) + filters, user_choice)
                                     
     page_size = 50
-    pages = math.ceil(num_choices / page_size)
-    page = request.args.get('page')  
-    if page is None:
-        page = 0
-
-    user_choice = user_choice.order_by('fema_id'
-                                       ).limit(page_size
-                                       ).offset(int(page)*page_size
-                                       ).all()
+    cursor = request.args.get('cursor')
+
+    user_choice, next_cursor, previous_cursor = keyset_page(
+        user_choice, Incident.fema_id, cursor, page_size)
+    next_url = page_url(next_cursor)
+    previous_url = page_url(previous_cursor)
     
     if not user_choice:
         flash('There are no events of this type that are in this datebase.')
         return redirect('/search')
 
-    user_id = session.get('user_id')
-    user = None
-    user_saved_searches = None
-
-    if user_id is not None:
-        user = User.query.filter_by(id=user_id).one()
-
-        user_saved_searches = user.searches
-
     return render_template('user-results.html',
                            state_id=state_id,
                            disaster_type=disaster_type,
@@ -349,9 +422,189 @@ def show_search_results():
                            year=year,
                            user_choice=user_choice,
                            num_choices=num_choices,
-                           pages=pages,
-                           user=user,
-                           user_saved_searches=user_saved_searches)
+                           next_url=next_url,
+                           previous_url=previous_url,
+                           user=g.user,
+                           user_saved_searches=g.user_saved_searches)
+
+
+@app.route('/api/funding/<dimension>')
+@dbpool.read_only
+def show_funding_rollups(dimension):
+    """Serve funding totals by state, disaster type, year or county"""
+
+    if dimension not in funding.DIMENSIONS:
+        return jsonify(error=f"Unknown dimension {dimension}"), 404
+
+    rollups = funding.get_rollups(dimension,
+                                  key=request.args.get('key'),
+                                  grant=request.args.get('grant'))
+
+    if dimension == 'county':
+        return jsonify(dimension=dimension, rollups=rollups,
+                       note=funding.COUNTY_NOTE)
+
+    return jsonify(dimension=dimension, rollups=rollups)
+
+
+@app.route('/api/funding/incidents/<int:fema_id>')
+@dbpool.read_only
+def show_incident_funding(fema_id):
+    """Serve the funding totals of one incident"""
+
+    return jsonify(fema_id=fema_id,
+                   funding=funding.get_incident_funding(fema_id))
+
+
+@app.route('/api/events')
+@dbpool.read_only
+@compress.conditional
+def api_events():
+    """Serve a page of incidents matching the search filters as JSON"""
+
+    filters = search_filters()
+
+    incidents = Incident.query.options(selectinload(Incident.grants))
+    incidents = filter_events(incidents, model=Incident, **filters)
+    count = stats.cached_count(('api',) + tuple(filters.values()), incidents)
+
+    page_size = request.args.get('page-size', API_PAGE_SIZE, type=int)
+    page_size = min(max(page_size, 1), MAX_API_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+
+    incidents, next_cursor, previous_cursor = keyset_page(
+        incidents, Incident.fema_id, cursor, page_size)
+
+    return jsonify(count=count,
+                   incidents=[export.incident_dict(incident)
+                              for incident in incidents],
+                   next=page_url(next_cursor),
+                   previous=page_url(previous_cursor))
+
+
+@app.route('/api/events/<int:fema_id>')
+@dbpool.read_only
+@compress.conditional
+def api_event(fema_id):
+    """Serve one incident with its counties and their grants as JSON"""
+
+    incident = Incident.query.options(selectinload(Incident.grants)
+                                      ).get(fema_id)
+    if incident is None:
+        return jsonify(error=f"No incident {fema_id}"), 404
+
+    counties = Event.query.options(joinedload(Event.grants)
+                                   ).filter_by(fema_id=fema_id
+                                   ).order_by(Event.county).all()
+
+    data = export.incident_dict(incident)
+    data['counties'] = [export.event_dict(event) for event in counties]
+
+    return jsonify(data)
+
+
+@app.route('/api/search')
+@dbpool.read_only
+def api_search():
+    """Suggest incidents whose name, type or counties start with the query"""
+
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', searchindex.MAX_RESULTS, type=int)
+    limit = min(max(limit, 1), searchindex.MAX_RESULTS)
+
+    return jsonify(query=query, results=searchindex.search(query, limit))
+
+
+@app.route('/api/facets')
+@dbpool.read_only
+def api_facets():
+    """Count the declarations matching the search filters, per filter value
+
+    Each filter's counts have every other filter applied, so they say how
+    many declarations choosing that value would find.
+    """
+
+    return jsonify(facets.counts(**search_filters()))
+
+
+@app.route('/api/export/<any(events, grants):table>.<any(ndjson, csv):fmt>')
+@dbpool.read_only
+def export_rows(table, fmt):
+    """Stream every event or grant matching the search filters
+
+    Rows are sent as they are read from a server-side cursor, so the
+    whole table can be exported without holding it in memory.
+    """
+
+    query, fields = export.export_query(table)
+    rows = export.stream_rows(filter_events(query, **search_filters()))
+
+    return Response(stream_with_context(export.export_chunks(fmt, rows,
+                                                             fields)),
+                    mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition':
+                             f'attachment; filename={table}.{fmt}'})
+
+
+@app.route('/api/geo/<any(state, county):level>')
+@dbpool.read_only
+def api_geo(level):
+    """Serve incident counts and funding per state or county for the map
+
+    ?format=geojson (the default) gives a GeoJSON FeatureCollection and
+    ?format=columns the same regions as compact rows. ?grant= limits the
+    funding to one grant type.
+    """
+
+    fmt = request.args.get('format', 'geojson')
+    if fmt not in geo.FORMATS:
+        return jsonify(error=f"Unknown format {fmt}"), 400
+
+    grant = request.args.get('grant') or None
+    if grant is not None and not GrantType.query.filter_by(name=grant
+                                                           ).count():
+        return jsonify(error=f"Unknown grant type {grant}"), 400
+
+    response = jsonify(geo.get_regions(level, grant, fmt))
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = GEO_MAX_AGE
+
+    return response.make_conditional(request)
+
+
+@app.route('/api/timeseries/<any(month, year):interval>')
+@dbpool.read_only
+def api_timeseries(interval):
+    """Serve declaration counts and funding per month or year
+
+    Takes the search filters of /api/events, and ?grant= to total one
+    grant type instead of all of them.
+    """
+
+    grant = request.args.get('grant') or None
+    if grant is not None and not GrantType.query.filter_by(name=grant
+                                                           ).count():
+        return jsonify(error=f"Unknown grant type {grant}"), 400
+
+    series = timeseries.series(interval, grant, **search_filters())
+
+    return jsonify(interval=interval, grant=grant, **series)
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Show request, SQL, template and pool metrics for Prometheus"""
+
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/metrics/pool')
+def show_pool_metrics():
+    """Show connection pool checkout waits and saturation as JSON"""
+
+    return jsonify(dbpool.pool_stats())
 
 
 @app.route('/about')
@@ -372,7 +625,8 @@ def show_contact_page():
 def us_map():
     """Show a map of the entire United States without markers"""
 
-    return render_template('us-map.html', google_api_key=google_api_key)
+    return render_template('beta-features/us-map.html',
+                           google_api_key=google_api_key)
 
 
 @app.route('/geolocate')
@@ -393,6 +647,23 @@ def places_locate():
 ###############################################################################
 
 
+def create_app(database=None):
+    """Connect the app to its database and return it for a WSGI server
+
+    The database URI comes from the argument, then $DATABASE_URL, then the
+    default in connect_to_db().
+    """
+
+    database = database or os.environ.get("DATABASE_URL")
+
+    if database:
+        connect_to_db(app, database)
+    else:
+        connect_to_db(app)
+
+    return app
+
+
 if __name__ == "__main__":
     connect_to_db(app)
     # DebugToolbarExtension(app)
@@ -0,0 +1,288 @@
+"""Parse the FEMA event.txt and grant.txt files on every core
+
+Each file is split into byte ranges that end on line breaks, and a
+process pool turns each range into typed records: dates are parsed,
+numbers converted and empty fields made None. The ranges are parsed in
+a bounded window ahead of the reader, so the records come back in file
+order and memory stays flat however large the file is.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import os
+import queue
+import threading
+import time
+
+
+# Column index in grant.txt of each grant type, also used as its id
+GRANT_TYPES = {1: "Total Public Assistance Grants (PA)",
+               2: "Emergency Work(Categories A-B)",
+               3: "Permanent Work (Categories C-G)",
+               4: "Total Individual & Households Program (IHP)",
+               5: "Total Individual Assistance (IA) Applications",
+               6: "Total Housing Assistance (HA)",
+               7: "Total Other Needs Assistance (ONA)"}
+
+# Column of grant.txt with the time FEMA last updated the line
+GRANT_REPORTED_ON = len(GRANT_TYPES) + 1
+
+# Bytes parsed by one task; big enough that pickling results is cheap
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Parsed ranges waiting for the reader, per process
+QUEUED_PER_PROCESS = 2
+
+
+###############################################################################
+# Lines to records
+
+
+def fema_id_of(value):
+    """Turn the FEMA ID field into an int, raising ValueError if empty"""
+
+    if value is None:
+        raise ValueError("no FEMA ID")
+
+    return int(value)
+
+
+def fields(line):
+    """Split a line of a FEMA file into its fields, with "" as None"""
+
+    return [None if value == "" else value
+            for value in line.rstrip().replace("\t", "").split("|")]
+
+
+def parse_date(value):
+    """Turn an ISO timestamp from the FEMA files into a date"""
+
+    if value is None:
+        return None
+
+    # Slicing the fixed-width fields is several times faster than strptime
+    return date(int(value[:4]), int(value[5:7]), int(value[8:10]))
+
+
+def parse_event(line):
+    """Turn one line of event.txt into a dict of Event column values"""
+
+    (declaration_id, fema_id, state_id, state, name, county, start_date,
+     end_date, declared_on, close_out_date, disaster_type) = fields(line)
+
+    name = (name or "").lower().title()
+    name = f"{state_id} {name}"
+
+    return {"declaration_id": declaration_id,
+            "fema_id": fema_id_of(fema_id),
+            "state_id": state_id,
+            "name": name,
+            "county": county,
+            "start_date": parse_date(start_date),
+            "end_date": parse_date(end_date),
+            "declared_on": parse_date(declared_on),
+            "close_out_date": parse_date(close_out_date),
+            "disaster_type": disaster_type,
+            # Not in the file; set here since COPY skips the ORM default
+            "damaged_property": False}
+
+
+def parse_grant(line):
+    """Turn one line of grant.txt into its FEMA ID, totals and report date
+
+    totals maps each grant type id with an amount on the line to it.
+    """
+
+    row = fields(line)
+    reported_on = (row[GRANT_REPORTED_ON] if len(row) > GRANT_REPORTED_ON
+                   else None)
+
+    return {"fema_id": fema_id_of(row[0]),
+            "totals": {index: float(row[index]) for index in GRANT_TYPES
+                       if row[index] is not None},
+            "reported_on": parse_date(reported_on)}
+
+
+PARSERS = {"event": parse_event, "grant": parse_grant}
+
+
+###############################################################################
+# Byte ranges
+
+
+def byte_ranges(path, chunk_size=CHUNK_SIZE):
+    """Split a file into (start, end) byte ranges that end on line breaks"""
+
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+
+    with open(path, "rb") as source:
+        while start < size:
+            source.seek(min(start + chunk_size, size))
+            source.readline()
+            end = min(source.tell(), size)
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def parse_range(path, kind, start, end):
+    """Parse the lines between two byte offsets of a file
+
+    Returns the records, the lines and bytes read, the CPU seconds this
+    process spent on them, and (line number, reason) for each line that
+    could not be parsed. Line numbers count from 0 at start.
+    """
+
+    started = time.process_time()
+    parse = PARSERS[kind]
+
+    with open(path, "rb") as source:
+        source.seek(start)
+        text = source.read(end - start).decode("utf-8")
+
+    # Only "\n" ends a line, as in byte_ranges(); splitlines() would also
+    # break on form feeds and other separators inside a field
+    lines = text.split("\n")
+    records = []
+    skipped = []
+    for number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            records.append(parse(line))
+        except (ValueError, IndexError) as error:
+            skipped.append((number, str(error)))
+
+    # A file's last line may have no "\n" after it
+    return (records, len(lines) - (lines[-1] == ""), end - start,
+            time.process_time() - started, skipped)
+
+
+###############################################################################
+# Reading whole files
+
+
+class ParseReport(object):
+    """Lines, bytes and CPU time of parsing one file, for the seed log
+
+    skipped holds (line number, reason) for lines that could not be
+    parsed, counting from 1 like an editor.
+    """
+
+    def __init__(self):
+        self.processes = 1
+        self.skipped = []
+        self.lines = 0
+        self.bytes = 0
+        self.cpu_seconds = 0.0
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    def add(self, lines, size, cpu_seconds, skipped=()):
+        """Count one parsed range, its skipped lines numbered in the file"""
+
+        self.skipped.extend((self.lines + number + 1, reason)
+                            for number, reason in skipped)
+        self.lines += lines
+        self.bytes += size
+        self.cpu_seconds += cpu_seconds
+        self.seconds = time.perf_counter() - self.started
+
+    def per_core(self):
+        """Return the lines and megabytes parsed per CPU second"""
+
+        if not self.cpu_seconds:
+            return 0.0, 0.0
+
+        return (self.lines / self.cpu_seconds,
+                self.bytes / 1e6 / self.cpu_seconds)
+
+    def __str__(self):
+        lines_per_core, megabytes_per_core = self.per_core()
+
+        processes = "1 process" if self.processes == 1 else (
+            f"{self.processes} processes")
+
+        summary = (f"Parsed {self.lines} lines ({self.bytes / 1e6:.1f} MB) on "
+                   f"{processes}: {lines_per_core:.0f} lines/s "
+                   f"({megabytes_per_core:.1f} MB/s) per core, "
+                   f"{self.cpu_seconds:.1f} CPU s in {self.seconds:.1f}s")
+
+        return "\n".join([summary] + [f"  Skipped line {number}: {reason}"
+                                      for number, reason in self.skipped])
+
+
+def parsed_ranges(path, kind, ranges, processes, queue_size):
+    """Yield parse_range() results in file order, parsing ahead in a pool
+
+    A feeder thread submits ranges to the pool and puts their futures on
+    a queue of queue_size, so at most that many parsed ranges wait for
+    the reader however slowly it writes them to the database.
+    """
+
+    pending = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    with ProcessPoolExecutor(processes) as executor:
+        def submit_ranges():
+            for start, end in ranges:
+                if stop.is_set():
+                    break
+                pending.put(executor.submit(parse_range, path, kind,
+                                            start, end))
+            pending.put(None)
+
+        feeder = threading.Thread(target=submit_ranges, daemon=True)
+        feeder.start()
+
+        try:
+            while True:
+                future = pending.get()
+                if future is None:
+                    break
+                yield future.result()
+        finally:
+            # The reader stopped early: let the feeder finish and drop the
+            # parses nobody will read
+            stop.set()
+            while feeder.is_alive() or not pending.empty():
+                try:
+                    future = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if future is not None:
+                    future.cancel()
+
+
+def read_records(path, kind, processes=None, chunk_size=CHUNK_SIZE,
+                 report=None):
+    """Yield the typed records of an "event" or "grant" file in order
+
+    Files of one chunk, or processes=1, are parsed in this process.
+    Each parsed range is added to report, a ParseReport, if given.
+    Lines that cannot be parsed, like ones with no FEMA ID, are left out
+    and listed in report.skipped.
+    """
+
+    processes = processes or os.cpu_count() or 1
+    ranges = byte_ranges(path, chunk_size)
+
+    if processes == 1 or len(ranges) <= 1:
+        processes = 1
+        results = (parse_range(path, kind, start, end)
+                   for start, end in ranges)
+    else:
+        results = parsed_ranges(path, kind, ranges, processes,
+                                processes * QUEUED_PER_PROCESS)
+
+    if report is not None:
+        report.processes = processes
+
+    for records, lines, size, cpu_seconds, skipped in results:
+        if report is not None:
+            report.add(lines, size, cpu_seconds, skipped)
+        yield from records
@@ -0,0 +1,35 @@
+"use strict";
+
+// Show how many declarations each search option finds with the other
+// filters applied, updating the counts whenever a filter changes
+const facetFields = {
+    "state": "state_id",
+    "disaster-type": "disaster_type",
+    "declaration-id": "declaration_id",
+    "year": "year",
+    "month": "month",
+};
+
+function showFacetCounts(result) {
+    for (const [field, facet] of Object.entries(facetFields)) {
+        const counts = result.facets[facet];
+
+        $(`#disaster-form select[name="${field}"] option`).each(function () {
+            const value = $(this).val();
+
+            // "All" and the empty year/month options have no count
+            if (value === "all" || value === "") {
+                return;
+            }
+
+            const label = $(this).text().replace(/ \(\d+\)$/, "");
+            $(this).text(`${label} (${counts[value] || 0})`);
+        });
+    }
+}
+
+function updateFacetCounts() {
+    $.get("/api/facets", $("#disaster-form").serialize(), showFacetCounts);
+}
+
+$("#disaster-form select").on("change", updateFacetCounts);
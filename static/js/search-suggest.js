@@ -0,0 +1,32 @@
+"use strict";
+
+// Suggest incidents under the navbar search box as the user types
+let suggestTimer = null;
+
+function showSuggestions(result) {
+    const suggestions = $("#search-suggestions");
+
+    suggestions.empty();
+    for (const incident of result.results) {
+        suggestions.append(
+            $("<option>").val(incident.fema_id).text(
+                `${incident.name} (${incident.state_id}, ${incident.declared_on})`)
+            );
+    }
+}
+
+function suggestIncidents() {
+    const query = $(this).val();
+
+    clearTimeout(suggestTimer);
+
+    // A FEMA ID goes straight to its event page, so there is nothing to suggest
+    if (/^\d*$/.test(query.trim())) {
+        return;
+    }
+
+    suggestTimer = setTimeout(
+        () => $.get("/api/search", {q: query}, showSuggestions), 150);
+}
+
+$("#navbar-search").on("input", suggestIncidents);
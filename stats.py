@@ -0,0 +1,113 @@
+"""Cached disaster declaration counts for the California Disaster project"""
+
+from sqlalchemy import extract, func
+from model import Incident, SeedRun, db
+
+import threading
+
+
+# Most search filter counts kept before the oldest is dropped
+MAX_CACHED_COUNTS = 1024
+
+_lock = threading.Lock()
+_cache = {}
+
+###############################################################################
+# Data version
+
+
+def data_version():
+    """Return the id of the latest seed run, or None if never seeded"""
+
+    return db.session.query(func.max(SeedRun.id)).scalar()
+
+
+def invalidate():
+    """Drop the cached counts so the next lookup recomputes them"""
+
+    with _lock:
+        _cache.clear()
+
+
+def _check_version(version):
+    """Drop everything cached for an older seed run; call with _lock held"""
+
+    if _cache.get("version") != version:
+        _cache.clear()
+        _cache["version"] = version
+
+
+###############################################################################
+# Declaration counts
+
+
+def _count_by(column):
+    """Count incidents grouped by the given column"""
+
+    rows = db.session.query(column, func.count(Incident.fema_id)
+                            ).group_by(column).all()
+
+    return {key: count for key, count in rows}
+
+
+def _compute_counts():
+    """Count distinct incidents overall and per state, type and year"""
+
+    total = db.session.query(func.count(Incident.fema_id)).scalar()
+
+    year = extract('year', Incident.declared_on)
+
+    return {"total": total or 0,
+            "by_state": _count_by(Incident.state_id),
+            "by_type": _count_by(Incident.disaster_type),
+            "by_year": {int(key): count
+                        for key, count in _count_by(year).items()
+                        if key is not None}}
+
+
+def get_counts():
+    """Return the distinct incident counts, recomputing after a reseed"""
+
+    version = data_version()
+
+    with _lock:
+        _check_version(version)
+        if "counts" in _cache:
+            return _cache["counts"]
+
+    counts = _compute_counts()
+
+    with _lock:
+        if _cache.get("version") == version:
+            _cache["counts"] = counts
+
+    return counts
+
+
+def total_incidents():
+    """Return the number of distinct disaster declarations"""
+
+    return get_counts()["total"]
+
+
+def cached_count(key, query):
+    """Return query.count(), remembered under key until the next reseed"""
+
+    version = data_version()
+
+    with _lock:
+        _check_version(version)
+        counts = _cache.setdefault("queries", {})
+        if key in counts:
+            return counts[key]
+
+    count = query.count()
+
+    with _lock:
+        if _cache.get("version") == version:
+            counts = _cache.setdefault("queries", {})
+            if len(counts) >= MAX_CACHED_COUNTS:
+                counts.pop(next(iter(counts)))
+            counts[key] = count
+
+    return count
@@ -1,6 +1,31 @@
+import base64
+import gzip
+import io
+import json
+import os
+import tempfile
 import unittest
+import zipfile
 import server 
-from model import connect_to_db, db, User
+import dbpool
+import facets
+import fetch_centroids
+import funding
+import geo
+import incidents
+import pagination
+import responsecache
+import searchindex
+import seed
+import sourcefiles
+import stats
+import timeseries
+from model import connect_to_db, db, Centroid, Event, FundingRollup, Grant
+from model import GrantType
+from model import Incident, IncidentFunding, SeedRun, User, UserSearch
+from sqlalchemy import create_engine, event as sqla_event
+from flask import g
+from datetime import date
 class TestServer(unittest.TestCase):
     
     def setUp(self):
@@ -11,6 +36,11 @@ class TestServer(unittest.TestCase):
         
         db.create_all()
         example_data()
+        responsecache.clear()
+        searchindex.invalidate()
+        geo.invalidate()
+        facets.invalidate()
+        timeseries.invalidate()
 
         with self.client as c:
             with c.session_transaction() as sess:
@@ -23,6 +53,366 @@ class TestServer(unittest.TestCase):
         result = self.client.get('/')
         self.assertIn(b'<li>User.query.first().id</li>', result.data)
 
+    def count_queries(self, url):
+        """Get url and return the SQL statements it ran"""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        sqla_event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            result = self.client.get(url)
+        finally:
+            sqla_event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(result.status_code, 200)
+        return statements
+
+    def test_event_info_single_query(self):
+        """Event page loads its counties and grants in one query"""
+
+        with self.client.session_transaction() as sess:
+            sess.pop('user_id')
+
+        statements = self.count_queries('/events/4000')
+        event_statements = [statement for statement in statements
+                            if 'events' in statement]
+
+        self.assertEqual(len(event_statements), 1)
+
+    def test_search_results_batch_grants(self):
+        """Search results load grants for the whole page in one query"""
+
+        with self.client.session_transaction() as sess:
+            sess.pop('user_id')
+
+        statements = self.count_queries('/search/results?state=CA'
+                                        '&disaster-type=all'
+                                        '&declaration-id=all'
+                                        '&year=&month=')
+        grant_statements = [statement for statement in statements
+                            if 'incident_funding' in statement]
+
+        self.assertEqual(len(grant_statements), 1)
+
+    def test_anonymous_search_results_cached(self):
+        """Anonymous visitors share cached pages keyed on the exact args"""
+
+        with self.client.session_transaction() as sess:
+            sess.pop('user_id')
+
+        url = ('/search/results?state=CA&disaster-type=all'
+               '&declaration-id=all&year=&month=')
+        first = self.client.get(url)
+        statements = self.count_queries(url)
+        self.assertFalse([statement for statement in statements
+                          if 'incidents' in statement])
+
+        result = self.client.get(url, headers={
+            'If-Modified-Since': first.headers['Last-Modified']})
+        self.assertEqual(result.status_code, 304)
+        result = self.client.get(url, headers={
+            'If-None-Match': first.headers['ETag']})
+        self.assertEqual(result.status_code, 304)
+
+        padded = self.client.get(url.replace('state=CA', 'state=%20CA'))
+        self.assertNotEqual(padded.data, first.data)
+
+    def test_search_suggestions(self):
+        """Every word of the query matches the start of a word"""
+
+        result = self.client.get('/api/search?q=los+ang+wildf')
+        results = result.get_json()['results']
+
+        self.assertEqual([incident['fema_id'] for incident in results], [4000])
+
+    def test_events_search_no_match(self):
+        """A navbar search matching nothing goes back to the list"""
+
+        result = self.client.get('/events?fema-id=atlantis')
+        self.assertEqual(result.status_code, 302)
+        self.assertTrue(result.location.endswith('/events'))
+
+        result = self.client.get('/events')
+        self.assertIn(b'No matching disaster was found.', result.data)
+
+    def test_geo_states(self):
+        """Each state is one point with its incident count and funding"""
+
+        result = self.client.get('/api/geo/state')
+        feature, = result.get_json()['features']
+
+        self.assertEqual(feature['geometry']['coordinates'],
+                         [-119.4696, 37.1841])
+        self.assertEqual(feature['properties']['incidents'], 1)
+        self.assertEqual(feature['properties']['funding'], 2500)
+
+    def test_geo_state_default_total(self):
+        """A state's default funding is PA plus IHP, not every grant type"""
+
+        add_nested_grants()
+        geo.invalidate()
+
+        result = self.client.get('/api/geo/state')
+        feature, = result.get_json()['features']
+
+        self.assertEqual(feature['properties']['funding'], 2500 + 400)
+
+    def test_cached_count_after_reseed(self):
+        """A reseed seen first by get_counts still refreshes query counts"""
+
+        stats.invalidate()
+        self.assertEqual(stats.cached_count('all', Incident.query), 1)
+
+        db.session.add_all([Incident(fema_id=4001, state_id='CA'),
+                            SeedRun()])
+        db.session.commit()
+
+        self.assertEqual(stats.get_counts()['total'], 2)
+        self.assertEqual(stats.cached_count('all', Incident.query), 2)
+
+    def test_cursor_round_trip(self):
+        """A page token decodes back to its direction and FEMA ID"""
+
+        for direction in ('after', 'before'):
+            token = pagination.encode_cursor(direction, 4000)
+            self.assertEqual(pagination.decode_cursor(token),
+                             (direction, 4000))
+
+    def test_invalid_cursors(self):
+        """Malformed page tokens are ignored instead of failing the page"""
+
+        def token(payload):
+            return base64.urlsafe_b64encode(payload.encode()).decode()
+
+        for cursor in ('', 'not base64!', token('not json'), token('[1]'),
+                       token('4000'), token('"after"'), token('{}'),
+                       token('{"after": 1, "before": 2}'),
+                       token('{"sideways": 4000}'), token('{"after": "1"}'),
+                       token('{"after": true}')):
+            self.assertIsNone(pagination.decode_cursor(cursor), cursor)
+
+        result = self.client.get('/events?cursor=' + token('[1]'))
+        self.assertEqual(result.status_code, 200)
+
+    def test_pool_label_after_dispose(self):
+        """A disposed pool's replacement is listed under the same label"""
+
+        primary = dbpool.pools.get('primary')
+        engine = create_engine('sqlite://', poolclass=dbpool.TimedQueuePool,
+                               label='test-replica')
+        try:
+            engine.dispose()
+            self.assertIs(dbpool.pools['test-replica'], engine.pool)
+            self.assertEqual(engine.pool.label, 'test-replica')
+            self.assertIs(dbpool.pools.get('primary'), primary)
+        finally:
+            dbpool.pools.pop('test-replica', None)
+
+    def test_read_only_routes_to_replica(self):
+        """Sessions use the replica only while a read_only view runs"""
+
+        binds = server.app.config.get('SQLALCHEMY_BINDS')
+        server.app.config['SQLALCHEMY_BINDS'] = {dbpool.REPLICA: 'sqlite://'}
+        replica = db.get_engine(server.app, bind=dbpool.REPLICA)
+
+        @dbpool.read_only
+        def view():
+            return db.session.get_bind()
+
+        try:
+            with server.app.test_request_context('/events'):
+                self.assertIs(view(), replica)
+                self.assertFalse(g.use_replica)
+                self.assertIsNot(db.session.get_bind(), replica)
+        finally:
+            server.app.config['SQLALCHEMY_BINDS'] = binds
+
+    def test_page_links_ignore_url_for_options(self):
+        """Query args like _scheme only end up in the next page's query"""
+
+        db.session.add(Incident(fema_id=4001, state_id='CA'))
+        db.session.commit()
+
+        result = self.client.get('/api/events?page-size=1&_external=1'
+                                 '&_scheme=javascript&_anchor=x')
+        self.assertEqual(result.status_code, 200)
+
+        link = result.get_json()['next']
+        self.assertTrue(link.startswith('/api/events?'), link)
+        self.assertIn('_scheme=javascript', link)
+
+    def test_geo_counties_placed(self):
+        """Counties from the gazetteer zip are placed on the map"""
+
+        gazetteer = io.BytesIO()
+        with zipfile.ZipFile(gazetteer, 'w') as archive:
+            archive.writestr('2018_Gaz_counties_national.txt',
+                             'USPS\tGEOID\tNAME\tINTPTLAT\tINTPTLONG   \n'
+                             'CA\t06007\tButte County\t39.665959\t'
+                             '-121.601919\n')
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'county_centroids.txt')
+            self.assertEqual(fetch_centroids.write_counties(gazetteer, path),
+                             1)
+            seed.load_centroids(counties_path=path)
+        geo.invalidate()
+
+        result = self.client.get('/api/geo/county')
+        features = result.get_json()['features']
+
+        self.assertEqual([feature['properties']['id']
+                          for feature in features], ['CA|butte'])
+
+    def test_county_funding_counts_whole_incidents(self):
+        """Each county touched by an incident is credited its full funding"""
+
+        result = self.client.get('/api/funding/county')
+        body = result.get_json()
+
+        self.assertEqual(body['note'], funding.COUNTY_NOTE)
+        self.assertEqual({rollup['key']: rollup['total']
+                          for rollup in body['rollups']},
+                         {'CA|Butte': 2500, 'CA|Los Angeles': 2500})
+
+        state = self.client.get('/api/funding/state').get_json()
+        self.assertEqual([rollup['total'] for rollup in state['rollups']],
+                         [2500])
+        self.assertNotIn('note', state)
+
+    def test_metrics(self):
+        """Requests show up on /metrics in the Prometheus text format"""
+
+        self.client.get('/events/4000')
+        result = self.client.get('/metrics')
+
+        self.assertIn(b'http_requests_total{endpoint="show_user_events_info",'
+                      b'method="GET",status="200"}', result.data)
+        self.assertIn(b'template_render_seconds_count'
+                      b'{template="event-info.html"}', result.data)
+
+    def test_export_events_ndjson(self):
+        """Export streams one JSON line per matching county row"""
+
+        result = self.client.get('/api/export/events.ndjson?state=CA')
+        lines = result.get_data(as_text=True).splitlines()
+
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['county'] for line in lines],
+                         ['Butte', 'Los Angeles'])
+
+    def test_facets(self):
+        """Facet counts apply every filter but the facet's own"""
+
+        result = self.client.get('/api/facets?state=TX&disaster-type=Fire')
+        counts = result.get_json()
+
+        self.assertEqual(counts['total'], 0)
+        self.assertEqual(counts['facets']['state_id'], {'CA': 1})
+        self.assertEqual(counts['facets']['disaster_type'], {})
+
+    def test_timeseries_years(self):
+        """Each year counts its declarations and their funding"""
+
+        Incident.query.update({'declared_on': date(2017, 10, 9)})
+        db.session.commit()
+
+        result = self.client.get('/api/timeseries/year?state=CA')
+        series = result.get_json()
+
+        self.assertEqual(series['buckets'], ['2017'])
+        self.assertEqual(series['declarations'], [1])
+        self.assertEqual(series['funding'], [2500])
+
+    def test_source_file_ranges(self):
+        """Parsing grant.txt in small ranges on a pool matches one pass"""
+
+        path = 'seed_data/grant.txt'
+        report = sourcefiles.ParseReport()
+        parallel = list(sourcefiles.read_records(path, 'grant', processes=2,
+                                                 chunk_size=512,
+                                                 report=report))
+        with open(path) as grant_file:
+            expected = [sourcefiles.parse_grant(line)
+                        for line in grant_file if line.strip()]
+
+        self.assertEqual(parallel, expected)
+        self.assertEqual(report.lines, len(expected))
+        self.assertEqual(expected[0]['reported_on'], date(2018, 8, 5))
+
+    def test_timeseries_default_funding(self):
+        """Default funding leaves out PA subcategories and IA counts"""
+
+        Incident.query.update({'declared_on': date(2017, 10, 9)})
+        db.session.commit()
+        add_nested_grants()
+
+        series = self.client.get('/api/timeseries/year').get_json()
+        self.assertEqual(series['funding'], [2500 + 400])
+
+        result = self.client.get('/api/timeseries/year?grant='
+                                 'Emergency+Work(Categories+A-B)')
+        self.assertEqual(result.get_json()['funding'], [300])
+
+    def test_source_file_field_separators(self):
+        """Only newlines end a line, not form feeds inside a field"""
+
+        line = ('DR\t|\t4000\t|\tCA\t|\tCalifornia\t|\tWILD\x0cFIRES\t|\t'
+                'Butte\u2028(County)\t|\t2017-10-09T00:00:00.000Z\t|\t\t|\t'
+                '2017-10-10T00:00:00.000Z\t|\t\t|\tFire\r\n')
+        with tempfile.NamedTemporaryFile('w', suffix='.txt',
+                                         encoding='utf-8') as event_file:
+            event_file.write(line * 2)
+            event_file.flush()
+            records = list(sourcefiles.read_records(event_file.name, 'event',
+                                                    processes=1))
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['county'], 'Butte\u2028(County)')
+        self.assertEqual(records[0]['declared_on'], date(2017, 10, 10))
+
+    def test_sync_events_counts(self):
+        """Syncing counts unchanged, updated and new events, skipping bad lines"""
+
+        def line(fema_id, county, disaster_type):
+            return (f'DR\t|\t{fema_id}\t|\tCA\t|\tCalifornia\t|\t'
+                    f'WILDFIRES\t|\t{county}\t|\t\t|\t\t|\t\t|\t\t|\t'
+                    f'{disaster_type}\n')
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as event_file:
+            event_file.write(line(4000, 'Butte', 'Fire')
+                             + line(4000, 'Los Angeles', 'Flood')
+                             + line('', 'Napa', 'Fire')
+                             + line(4001, 'Napa', 'Fire'))
+            event_file.flush()
+            try:
+                counts = seed.sync_events(event_file.name, processes=1)
+            finally:
+                db.session.rollback()
+
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1,
+                                  'unchanged': 1})
+
+    def test_event_info_gzip_and_not_modified(self):
+        """Event pages are gzipped and answer a matching ETag with 304"""
+
+        plain = self.client.get('/events/4000')
+        result = self.client.get('/events/4000',
+                                 headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(result.data), plain.data)
+
+        etag = result.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        result = self.client.get('/events/4000',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+
     # def test_register_user(self):
     #     self.assertEqual('foo'.upper(), 'jOO')
 
@@ -40,10 +430,15 @@ def example_data():
     """Create some sample data."""
 
     # In case this is run more than once, empty out existing data
-    # Event.query.delete()
-    # Grant.query.delete()
+    UserSearch.query.delete()
+    Grant.query.delete()
+    Incident.query.delete()
+    IncidentFunding.query.delete()
+    FundingRollup.query.delete()
+    Centroid.query.delete()
+    GrantType.query.delete()
+    Event.query.delete()
     User.query.delete()
-    # UserSearch.query.delete()
 
     # Add sample incidents and Events
     # df = Event(fema_id='fin', dept='Finance', phone='555-1000')
@@ -55,7 +450,41 @@ def example_data():
     # maggie = Employee(name='Maggie', dept=dm)
     # nadine = Employee(name='Nadine')
 
-    db.session.add_all([dog])
+    public_assistance = GrantType(id=1,
+                                  name='Total Public Assistance Grants (PA)')
+
+    fire = Event(declaration_id='DR', fema_id=4000, state_id='CA',
+                 name='CA Wildfires', county='Butte', disaster_type='Fire')
+    fire.grants.append(Grant(total=1000.0, grant_type=public_assistance))
+    fire_la = Event(declaration_id='DR', fema_id=4000, state_id='CA',
+                    name='CA Wildfires', county='Los Angeles',
+                    disaster_type='Fire')
+    fire_la.grants.append(Grant(total=2500.0,
+                                grant_type=public_assistance))
+
+    california = Centroid(state_id='CA', county='', name='California',
+                          latitude=37.1841, longitude=-119.4696)
+
+    db.session.add_all([dog, public_assistance, fire, fire_la, california])
+    db.session.commit()
+
+    incidents.refresh_incidents()
+    funding.refresh_funding()
+    db.session.commit()
+
+def add_nested_grants():
+    """Add IHP, a PA subcategory and an IA application count to fire 4000"""
+
+    fire = Event.query.filter_by(county='Los Angeles').one()
+    for grant_type_id, name, total in (
+            (2, 'Emergency Work(Categories A-B)', 300.0),
+            (4, 'Total Individual & Households Program (IHP)', 400.0),
+            (5, 'Total Individual Assistance (IA) Applications', 50.0)):
+        grant_type = GrantType(id=grant_type_id, name=name)
+        fire.grants.append(Grant(total=total, grant_type=grant_type))
+    db.session.commit()
+
+    funding.refresh_funding()
     db.session.commit()
 
 if __name__ == '__main__':
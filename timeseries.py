@@ -0,0 +1,199 @@
+"""Declarations and funding per month or year, for any search filters
+
+Every incident's declaration month and its funding by grant type are
+loaded once per seed run into NumPy arrays next to the facets snapshot
+of its filter columns. A series is then one mask of the filtered
+incidents and two bincounts over their month numbers: one counting them
+and one summing their funding.
+"""
+
+from model import GrantType, Incident, IncidentFunding, db
+from model import TOP_LEVEL_GRANT_TYPES
+
+import threading
+
+import numpy as np
+
+import facets
+import stats
+
+
+INTERVALS = ("month", "year")
+
+# Month number of incidents with no declaration date
+UNDATED = -1
+
+_lock = threading.Lock()
+_cache = {}
+
+
+class Snapshot(object):
+    """Declaration months, funding and filter columns of every incident"""
+
+    def __init__(self, rows, funding, grant_names):
+        """Build the arrays from incident rows and funding rows
+
+        rows are (fema_id, state_id, disaster_type, declaration_id,
+        declared_on) ordered by fema_id, and funding rows are (fema_id,
+        grant_type_id, total).
+        """
+
+        rows = list(rows)
+        self.filters = facets.Snapshot(
+            facets.filter_columns(row[1:] for row in rows))
+
+        self.fema_ids = np.fromiter((row[0] for row in rows),
+                                    dtype=np.int64, count=len(rows))
+        # Months since year 0, so a year is simply month // 12
+        self.months = np.fromiter(
+            (row[4].year * 12 + row[4].month - 1 if row[4] else UNDATED
+             for row in rows),
+            dtype=np.int32, count=len(rows))
+
+        self.grant_names = grant_names
+        self.grant_columns = {grant_id: column for column, grant_id
+                              in enumerate(sorted(grant_names))}
+        self.funding = np.zeros((len(rows), len(grant_names)))
+
+        funding = list(funding)
+        if funding and rows:
+            fema_ids, grant_ids, totals = (np.array(column)
+                                           for column in zip(*funding))
+            columns = np.array([self.grant_columns[grant_id]
+                                for grant_id in grant_ids])
+            positions = np.minimum(np.searchsorted(self.fema_ids, fema_ids),
+                                   len(rows) - 1)
+            # Funding of incidents missing from the incidents table is dropped
+            known = self.fema_ids[positions] == fema_ids
+            np.add.at(self.funding, (positions[known], columns[known]),
+                      totals[known])
+
+        # Subcategories and application counts would be counted twice
+        self.total_funding = self.funding[
+            :, [self.grant_columns[grant_id]
+                for grant_id in TOP_LEVEL_GRANT_TYPES
+                if grant_id in self.grant_columns]].sum(axis=1)
+
+        dated = self.months[self.months != UNDATED]
+        self.first_month = int(dated.min()) if len(dated) else None
+        self.last_month = int(dated.max()) if len(dated) else None
+
+        # Every series has the same buckets, so name them once
+        self.labels = {}
+        if self.first_month is not None:
+            for interval in INTERVALS:
+                first, last = self.span(interval)
+                self.labels[interval] = [bucket_label(interval, bucket)
+                                         for bucket in range(first, last + 1)]
+
+    def span(self, interval):
+        """Return the first and last bucket number of the data"""
+
+        if interval == "year":
+            return self.first_month // 12, self.last_month // 12
+
+        return self.first_month, self.last_month
+
+    def funding_column(self, grant=None):
+        """Return every incident's funding of one grant type, or in total
+
+        The total adds up the top-level dollar grant types only.
+        """
+
+        if grant is None:
+            return self.total_funding
+
+        for grant_id, name in self.grant_names.items():
+            if name == grant:
+                return self.funding[:, self.grant_columns[grant_id]]
+
+        return np.zeros(len(self.fema_ids))
+
+    def series(self, interval, filters, grant=None):
+        """Return the buckets, declaration counts and funding of the filters
+
+        Buckets run from the first to the last declaration of the whole
+        data set, so series for different filters line up.
+        """
+
+        if self.first_month is None:
+            return {"buckets": [], "declarations": [], "funding": []}
+
+        selected = self.filters.matching(filters)
+        selected &= self.months != UNDATED
+
+        buckets = self.months[selected]
+        if interval == "year":
+            buckets = buckets // 12
+
+        first, last = self.span(interval)
+        size = last - first + 1
+        declarations = np.bincount(buckets - first, minlength=size)
+        funding = np.bincount(buckets - first,
+                              weights=self.funding_column(grant)[selected],
+                              minlength=size)
+
+        return {"buckets": list(self.labels[interval]),
+                "declarations": declarations.tolist(),
+                "funding": np.round(funding, 2).tolist()}
+
+
+def bucket_label(interval, bucket):
+    """Name a bucket like 2005 or 2005-08"""
+
+    if interval == "year":
+        return str(bucket)
+
+    return f"{bucket // 12}-{bucket % 12 + 1:02d}"
+
+
+def build_snapshot():
+    """Load every incident's declaration month and funding"""
+
+    rows = db.session.query(Incident.fema_id, Incident.state_id,
+                            Incident.disaster_type, Incident.declaration_id,
+                            Incident.declared_on).order_by(Incident.fema_id)
+    funding = db.session.query(IncidentFunding.fema_id,
+                               IncidentFunding.grant_type_id,
+                               IncidentFunding.total)
+    grant_names = dict(db.session.query(GrantType.id, GrantType.name))
+
+    return Snapshot(rows, funding, grant_names)
+
+
+def get_snapshot():
+    """Return the snapshot of the current data, rebuilding it after a reseed"""
+
+    version = stats.data_version()
+
+    with _lock:
+        if _cache.get("version") == version and "snapshot" in _cache:
+            return _cache["snapshot"]
+
+    snapshot = build_snapshot()
+
+    with _lock:
+        _cache["version"] = version
+        _cache["snapshot"] = snapshot
+
+    return snapshot
+
+
+def invalidate():
+    """Drop the snapshot so the next lookup rebuilds it"""
+
+    with _lock:
+        _cache.clear()
+
+
+def series(interval, grant=None, state_id="all", disaster_type="all",
+           declaration_id="all", year=None, month=None):
+    """Count declarations and total funding per interval for the filters"""
+
+    return get_snapshot().series(interval,
+                                 {"state_id": state_id,
+                                  "disaster_type": disaster_type,
+                                  "declaration_id": declaration_id,
+                                  "year": year,
+                                  "month": month},
+                                 grant)
@@ -0,0 +1,9 @@
+"""WSGI entry point for serving the app in production
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from server import create_app
+
+
+app = create_app()